@@ -0,0 +1,322 @@
+# -*- coding: utf-8 -*-
+"""Benchmark suite of the training and scoring pipeline on synthetic data"""
+
+import argparse
+import io
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import numpy as np
+from proj1_helpers import *
+from dataprocessing import *
+from classifiers import *
+from benchmarks import timeit, peak_allocation
+from instrumentation import peak_rss
+
+
+# columns of the Higgs challenge files (after Id and Prediction)
+HIGGS_FEATURES = [
+    'DER_mass_MMC', 'DER_mass_transverse_met_lep', 'DER_mass_vis', 'DER_pt_h', 'DER_deltaeta_jet_jet',
+    'DER_mass_jet_jet', 'DER_prodeta_jet_jet', 'DER_deltar_tau_lep', 'DER_pt_tot', 'DER_sum_pt',
+    'DER_pt_ratio_lep_tau', 'DER_met_phi_centrality', 'DER_lep_eta_centrality', 'PRI_tau_pt', 'PRI_tau_eta',
+    'PRI_tau_phi', 'PRI_lep_pt', 'PRI_lep_eta', 'PRI_lep_phi', 'PRI_met', 'PRI_met_phi', 'PRI_met_sumet',
+    'PRI_jet_num', 'PRI_jet_leading_pt', 'PRI_jet_leading_eta', 'PRI_jet_leading_phi', 'PRI_jet_subleading_pt',
+    'PRI_jet_subleading_eta', 'PRI_jet_subleading_phi', 'PRI_jet_all_pt'
+]
+
+# share of the events with 0, 1, 2 and 3 jets in the training set
+JET_NUM_DISTRIBUTION = [0.3997, 0.3102, 0.2015, 0.0886]
+
+# share of the events with an undefined DER_mass_MMC
+MASS_MMC_UNDEFINED = 0.152
+
+# classifiers fitted and evaluated by the suite (logistic regressions are given the expanded data,
+# unregularized least squares the standardized data as the expansion has duplicate columns)
+SUITE_CLASSIFIERS = {
+    'least_squares'         : lambda expand: LeastSquares(),
+    'least_squares_L2'      : lambda expand: LeastSquaresL2(3.5938136638046255e-12, expand=expand),
+    'least_squares_L1'      : lambda expand: LeastSquaresL1(1e-4, expand=expand),
+    'logistic_regression'   : lambda expand: LogisticRegression(max_evaluations=100, solver='lbfgs'),
+    'logistic_regression_L2': lambda expand: LogisticRegressionL2(1.0, max_evaluations=100, solver='lbfgs'),
+    'logistic_regression_L1': lambda expand: LogisticRegressionL1(1.0, max_evaluations=100),
+}
+
+
+def generate_higgs_data(path, n, labels=True, seed=1, chunk_size=50000):
+    """
+    Writes a synthetic csv file shaped like the Higgs challenge data.
+
+    The file has the same 30 columns, PRI_jet_num follows the distribution of
+    the training set, the features undefined for a number of jets (see
+    UNDEFINED_FEATURES) are -999 and so is DER_mass_MMC for ~15% of the events.
+    The labels depend on a few features, so that the classifiers learn something.
+
+    :param path: path of the csv file
+    :param n: number of events
+    :param labels: write s/b labels (training file) instead of ? (test file)
+    :param seed: seed of the random generator
+    :param chunk_size: number of rows formatted at once
+    """
+
+    random = np.random.RandomState(seed)
+    d = len(HIGGS_FEATURES)
+
+    # energies and masses are positive and skewed, angles are uniform, pseudorapidities centred
+    X = np.exp(random.normal(4., 0.6, (n, d)))
+    for j, feature in enumerate(HIGGS_FEATURES):
+        if feature.endswith('_phi'):
+            X[:, j] = random.uniform(-np.pi, np.pi, n)
+        elif feature.endswith('_eta') or feature.endswith('centrality') or 'eta_jet' in feature:
+            X[:, j] = random.normal(0., 1.2, n)
+
+    jet_num = random.choice(4, n, p=JET_NUM_DISTRIBUTION)
+    X[:, HIGGS_FEATURES.index('PRI_jet_num')] = jet_num
+
+    # signal events have a smaller transverse mass and a larger visible mass
+    score = (- np.log(X[:, HIGGS_FEATURES.index('DER_mass_transverse_met_lep')])
+             + 0.5 * np.log(X[:, HIGGS_FEATURES.index('DER_mass_vis')])
+             + 0.3 * random.randn(n))
+    signal = score > np.quantile(score, 0.66)
+
+    for feature, levels in UNDEFINED_FEATURES.items():
+        if feature == 'PRI_jet_num':
+            continue
+        # the total jet momentum is 0 (not undefined) without jets
+        X[np.isin(jet_num, levels), HIGGS_FEATURES.index(feature)] = 0. if feature == 'PRI_jet_all_pt' else -999.
+    X[random.rand(n) < MASS_MMC_UNDEFINED, HIGGS_FEATURES.index('DER_mass_MMC')] = -999.
+
+    formats = [ '%d' if feature == 'PRI_jet_num' else '%.3f' for feature in HIGGS_FEATURES ]
+    with open(path, 'w') as f:
+        f.write(",".join(['Id', 'Prediction'] + HIGGS_FEATURES) + "\n")
+        for start in range(0, n, chunk_size):
+            stop = min(start + chunk_size, n)
+            body = io.StringIO()
+            np.savetxt(body, X[start:stop], fmt=formats, delimiter=',')
+
+            prediction = np.where(signal[start:stop], 's', 'b') if labels else ['?'] * (stop - start)
+            f.writelines(f"{100000 + i},{label},{line}\n"
+                         for i, label, line in zip(range(start, stop), prediction, body.getvalue().splitlines()))
+
+
+def measure(function, *args, repeat=1, memory=True):
+    """
+    Times a function call and measures the memory it allocates.
+
+    The time is the best of repeat calls, the peak memory is measured on an
+    additional call traced by tracemalloc (numpy reports its arrays to it).
+
+    :param function: function to measure
+    :param args: arguments of the function
+    :param repeat: number of timed calls
+    :param memory: measure the peak memory
+    :return: measurements (time, cpu_time, peak_memory), result of the last timed call
+    """
+
+    start_cpu = time.process_time()
+    wall_time, result = timeit(function, *args, repeat=repeat)
+    cpu_time = (time.process_time() - start_cpu) / repeat
+
+    measurement = {'time': wall_time, 'cpu_time': cpu_time}
+    if memory:
+        measurement['peak_memory'] = peak_allocation(function, *args)
+
+    return measurement, result
+
+
+def run_scale(n, directory, repeat=1, memory=True, d_int=10, d_sq=5, k_fold=4, verbose=True):
+    """
+    Measures every stage of the pipeline on synthetic data of a given size.
+
+    The stages are those of run.py and project1.ipynb: loading (csv and
+    binary cache), splitting, NaN handling, standardization, expansion,
+    the fitted Pipeline, the fit and predict of every classifier of
+    SUITE_CLASSIFIERS, cross-validation of a lambda path and the csv output.
+
+    :param n: number of rows of the training and of the test file
+    :param directory: directory of the generated files
+    :param repeat: number of timed calls per stage
+    :param memory: measure the peak memory of every stage
+    :param d_int: degree of integer powers of the expansion
+    :param d_sq: degree of half-powers of the expansion
+    :param k_fold: number of folds of the cross-validation
+    :param verbose: print every stage
+    :return: measurements of every stage
+    """
+
+    train_path, test_path = os.path.join(directory, f"train_{n}.csv"), os.path.join(directory, f"test_{n}.csv")
+    generate_higgs_data(train_path, n, labels=True, seed=1)
+    generate_higgs_data(test_path, n, labels=False, seed=2)
+
+    stages = {}
+
+    def stage(name, function, *args):
+        stages[name], result = measure(function, *args, repeat=repeat, memory=memory)
+        if verbose:
+            memory_text = f", {stages[name]['peak_memory'] / 2 ** 20:8.1f}MB" if memory else ""
+            print(f"  {name:32}: {stages[name]['time']:8.3f}s{memory_text}")
+        return result
+
+    # loading, the cache is written by the first cached call
+    y, tX, ids, features = stage('load_csv_data', lambda: load_csv_data(train_path, cache=False))
+    load_csv_data(train_path)
+    stage('load_csv_data_cached', load_csv_data, train_path)
+
+    # preprocessing steps of the notebook, split by split
+    _, X_split, y_split = stage('split_data', split_data, features, tX, y)
+    X_split = stage('remove_NaN_features', lambda: [ remove_NaN_features(X, 0.2) for X in X_split ])
+    X_split = stage('replace_NaN_by_median', lambda: [ replace_NaN_by_median(X) for X in X_split ])
+    X_split = stage('standardize', lambda: [ standardize(X)[0] for X in X_split ])
+    stage('build_X', lambda: [ build_X(X, d_int, d_sq) for X in X_split ])
+
+    # preprocessing of run.py
+    pipeline = Pipeline(features, 0.2, d_int, d_sq)
+    _, X_split, y_split = stage('pipeline_fit_transform', pipeline.fit_transform, tX, y, False)
+    _, tX_test, ids_test, _ = load_csv_data(test_path, cache=False)
+    split_indices, X_test_split, _ = stage('pipeline_transform', pipeline.transform, tX_test, None, False)
+
+    X_expanded = [ pipeline.expand(X) for X in X_split ]
+    X_test_expanded = [ pipeline.expand(X) for X in X_test_split ]
+
+    y_pred = np.ones(tX_test.shape[0])
+    for name, make_model in SUITE_CLASSIFIERS.items():
+        models = [ make_model(pipeline.expand) for _ in X_split ]
+        # logistic regressions do not expand the data themselves
+        X_fit, X_predict = (X_split, X_test_split) if hasattr(models[0], 'expand') else (X_expanded, X_test_expanded)
+
+        stage(f'fit_{name}', lambda: [ model.fit(y_, X) for model, X, y_ in zip(models, X_fit, y_split) ])
+        predictions = stage(f'predict_{name}', lambda: [ model.predict(X) for model, X in zip(models, X_predict) ])
+
+        if name == 'least_squares_L2':
+            for indices, y_pred_split in zip(split_indices, predictions):
+                y_pred[indices] = y_pred_split
+
+    lambdas = np.logspace(-12, -2, 6)
+    stage('cross_validate_kfold', lambda: [ cross_validate_kfold(y_, X, LeastSquaresL2(0, expand=pipeline.expand),
+                                                                 k_fold, lambdas)
+                                            for X, y_ in zip(X_split, y_split) ])
+
+    stage('create_csv_submission', create_csv_submission, ids_test, y_pred, os.path.join(directory, f"pred_{n}.csv"))
+
+    return stages
+
+
+def run_suite(scales, repeat=1, memory=True, verbose=True):
+    """
+    Runs the suite at several scales.
+
+    :param scales: numbers of rows
+    :param repeat: number of timed calls per stage
+    :param memory: measure the peak memory of every stage
+    :param verbose: print every stage
+    :return: results (metadata and measurements of every stage per scale)
+    """
+
+    results = {
+        'metadata': {
+            'date': time.strftime("%Y-%m-%dT%H:%M:%S"),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'repeat': repeat,
+        },
+        'scales': {},
+    }
+
+    with tempfile.TemporaryDirectory() as directory:
+        for n in scales:
+            if verbose:
+                print(f"{n} rows")
+            results['scales'][str(n)] = run_scale(n, directory, repeat, memory, verbose=verbose)
+
+    # peak resident memory of the whole suite, in bytes (None if it cannot be measured)
+    results['metadata']['max_rss'] = peak_rss()
+
+    return results
+
+
+def compare_to_baseline(results, baseline, tolerance=0.25, min_time=0.05, min_memory=2 ** 20):
+    """
+    Compares results with a baseline and lists the regressions.
+
+    A stage regresses when its time (or peak memory) exceeds the baseline by
+    more than tolerance, and by more than min_time (or min_memory) so that
+    the noise of very short stages is not flagged.
+
+    :param results: results of run_suite
+    :param baseline: results of a previous run_suite
+    :param tolerance: allowed relative increase
+    :param min_time: allowed absolute increase of the time, in seconds
+    :param min_memory: allowed absolute increase of the peak memory, in bytes
+    :return: regressions (scale, stage, metric, baseline value, new value)
+    """
+
+    thresholds = {'time': min_time, 'peak_memory': min_memory}
+
+    regressions = []
+    for scale, stages in results['scales'].items():
+        for name, measurement in stages.items():
+            reference = baseline['scales'].get(scale, {}).get(name)
+            if reference is None:
+                continue
+
+            for metric, threshold in thresholds.items():
+                if metric not in measurement or metric not in reference:
+                    continue
+                new, old = measurement[metric], reference[metric]
+                if new > old * (1 + tolerance) and new - old > threshold:
+                    regressions.append((scale, name, metric, old, new))
+
+    return regressions
+
+
+def print_comparison(results, baseline):
+    """
+    Prints the times of the results next to the baseline.
+
+    :param results: results of run_suite
+    :param baseline: results of a previous run_suite
+    """
+
+    for scale, stages in results['scales'].items():
+        print(f"{scale} rows: {'baseline':>10} {'new':>10} {'ratio':>7}")
+        for name, measurement in stages.items():
+            reference = baseline['scales'].get(scale, {}).get(name)
+            if reference is not None:
+                print(f"  {name:32}: {reference['time']:9.3f}s {measurement['time']:9.3f}s "
+                      f"{measurement['time'] / max(reference['time'], 1e-9):7.2f}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Times every stage of the pipeline on synthetic Higgs-shaped data")
+    parser.add_argument("--scales", type=int, nargs="+", default=[10000, 50000, 250000],
+                        help="numbers of rows of the generated training and test files")
+    parser.add_argument("--repeat", type=int, default=1, help="number of timed calls per stage (best is kept)")
+    parser.add_argument("--no-memory", dest="memory", action="store_false",
+                        help="do not measure the peak memory (one call less per stage)")
+    parser.add_argument("--output", default="../results/benchmarks.json", help="json file of the results")
+    parser.add_argument("--baseline", default=None, help="json file of previous results to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="relative increase of time or memory flagged as a regression")
+    args = parser.parse_args()
+
+    results = run_suite(args.scales, args.repeat, args.memory)
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+        print_comparison(results, baseline)
+        regressions = compare_to_baseline(results, baseline, args.tolerance)
+        for scale, name, metric, old, new in regressions:
+            print(f"REGRESSION {scale} rows, {name}, {metric}: {old:.4g} -> {new:.4g} ({new / old:.2f}x)")
+
+        # non-zero exit status so that the suite can gate a change
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,624 @@
+# -*- coding: utf-8 -*-
+"""Benchmarks"""
+
+import argparse
+import csv
+import functools
+import os
+import tempfile
+import tracemalloc
+import time
+import numpy as np
+import parallel
+import solver
+import streaming
+from proj1_helpers import *
+from dataprocessing import *
+from classifiers import *
+from implementations import *
+
+
+def timeit(function, *args, repeat=3, **kwargs):
+    """
+    Times a function call.
+
+    :param function: function to time
+    :param args: positional arguments of the function
+    :param repeat: number of repetitions (best time is kept)
+    :param kwargs: keyword arguments of the function
+    :return: best wall time in seconds, result of the last call
+    """
+
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function(*args, **kwargs)
+        best = min(best, time.perf_counter() - start)
+
+    return best, result
+
+
+def load_csv_data_genfromtxt(data_path, sub_sample=False):
+    """Reference loader parsing the file three times with np.genfromtxt"""
+    y = np.genfromtxt(data_path, delimiter=",", skip_header=1, dtype=str, usecols=1)
+    x = np.genfromtxt(data_path, delimiter=",", skip_header=1)
+    ids = x[:, 0].astype(int)
+    input_data = x[:, 2:]
+
+    features = np.genfromtxt(data_path, delimiter=",", dtype=str, max_rows=1)
+    features = features[2:]
+
+    yb = np.ones(len(y))
+    yb[np.where(y == 'b')] = -1
+
+    if sub_sample:
+        yb = yb[::50]
+        input_data = input_data[::50]
+        ids = ids[::50]
+
+    return yb, input_data, ids, list(features)
+
+
+def split_data_masks(features, X, y=None):
+    """Reference split copying X and evaluating the PRI_jet_num masks three times per level"""
+    # features that are undefined for some subsets
+    undef_feature_for = {
+        'DER_deltaeta_jet_jet'   : [0, 1],
+        'DER_mass_jet_jet'       : [0, 1],
+        'DER_prodeta_jet_jet'    : [0, 1],
+        'DER_lep_eta_centrality' : [0, 1],
+        'PRI_jet_num'            : [0, 1, 2, 3],
+        'PRI_jet_leading_pt'     : [0],
+        'PRI_jet_leading_eta'    : [0],
+        'PRI_jet_leading_phi'    : [0],
+        'PRI_jet_subleading_pt'  : [0, 1],
+        'PRI_jet_subleading_eta' : [0, 1],
+        'PRI_jet_subleading_phi' : [0, 1],
+        'PRI_jet_all_pt'         : [0]
+    }
+
+    # the feature based on which we split X
+    jet_num_feature = "PRI_jet_num"
+    jet_levels = 4
+
+    # build valid features for every subset of X
+    features_split = []
+    for jet in range(jet_levels):
+        valid_features = [ f for f in features if not ((f in undef_feature_for) and (jet in undef_feature_for[f])) ]
+        features_split.append(valid_features)
+        
+    # split data based on jet level (vertical split)
+    X_ = X.copy()
+    
+    split_indices = [
+        X_[:,features.index(jet_num_feature)] == i for i in range(jet_levels)
+    ]
+    X_split = [
+        X_[X_[:,features.index(jet_num_feature)] == i,:] for i in range(jet_levels)
+    ]
+    if y is None:
+        y_split = None
+    else:
+        y_split = [
+            y[X_[:,features.index(jet_num_feature)] == i] for i in range(jet_levels)
+        ]
+
+    # only keep relevant features (horizontal split)
+    for i, x in enumerate(X_split):
+        indices = [ features.index(feature) for feature in features_split[i] ]
+        indices_bool = [ e in indices for e in range(len(features)) ]
+        X_split[i] = x[:,indices_bool]
+        
+    return split_indices, X_split, y_split
+
+
+def benchmark_split_data(tX, features, repeat=3):
+    """
+    Compares split_data against the reference split with boolean masks.
+
+    :param tX: data
+    :param features: feature names
+    :param repeat: number of repetitions
+    """
+
+    t_ref, ref = timeit(split_data_masks, features, tX, repeat=repeat)
+    t_new, new = timeit(split_data, features, tX, repeat=repeat)
+
+    # same rows, in the same order, and same columns
+    for mask, indices, X_ref, X_new in zip(ref[0], new[0], ref[1], new[1]):
+        assert np.array_equal(np.flatnonzero(mask), indices) and np.array_equal(X_ref, X_new)
+
+    print(f"split_data ({tX.shape[0]} rows)")
+    print(f"  boolean masks      : {t_ref:.3f}s")
+    print(f"  sorted indices     : {t_new:.3f}s ({t_ref / t_new:.1f}x)")
+
+
+def benchmark_load_csv_data(data_path, repeat=3):
+    """
+    Compares load_csv_data against the genfromtxt reference loader.
+
+    :param data_path: path of the csv file
+    :param repeat: number of repetitions
+    """
+
+    t_ref, ref = timeit(load_csv_data_genfromtxt, data_path, repeat=repeat)
+    t_new, new = timeit(load_csv_data, data_path, repeat=repeat, cache=False)
+    t_f32, f32 = timeit(load_csv_data, data_path, repeat=repeat, dtype=np.float32, cache=False)
+    load_csv_data(data_path, rebuild_cache=True)
+    t_mmap, _ = timeit(load_csv_data, data_path, repeat=repeat)
+
+    # the streaming loader must return exactly the same data
+    assert all(np.array_equal(a, b) for a, b in zip(ref[:3], new[:3])) and ref[3] == new[3]
+
+    print(f"load_csv_data ({len(new[0])} rows)")
+    print(f"  genfromtxt x3      : {t_ref:.3f}s")
+    print(f"  streaming          : {t_new:.3f}s ({t_ref / t_new:.1f}x)")
+    print(f"  streaming float32  : {t_f32:.3f}s ({t_ref / t_f32:.1f}x)")
+    print(f"  memory-mapped cache: {t_mmap:.3f}s ({t_ref / t_mmap:.1f}x)")
+
+
+def remove_NaN_features_loop(x, threshold=0.0):
+    """Reference implementation growing the result column by column"""
+    n, d = x.shape
+    result = []
+
+    for j in range(d):
+        positions = x[:, j] == -999
+        if np.mean(positions) < threshold:
+            if not len(result):
+                result = x[:, j]
+            else:
+                result = np.c_[result, x[:, j]]
+
+    return result
+
+
+def replace_NaN_loop(x, statistic):
+    """Reference implementation replacing the -999 values column by column"""
+    result = x.copy()
+
+    for j in range(x.shape[1]):
+        positions = result[:, j] == -999
+        if np.sum(positions) > 0:
+            result[positions, j] = statistic(result[~positions, j])
+
+    return result
+
+
+def benchmark_nan_handling(tX, repeat=3):
+    """
+    Compares the vectorized NaN handling against column loops.
+
+    :param tX: data
+    :param repeat: number of repetitions
+    """
+
+    print(f"NaN handling ({tX.shape[0]}x{tX.shape[1]})")
+
+    benchmarks = [
+        ("remove_NaN_features", remove_NaN_features_loop, (0.2,), remove_NaN_features, (0.2,)),
+        ("replace_NaN_by_mean", replace_NaN_loop, (np.mean,), replace_NaN_by_mean, ()),
+        ("replace_NaN_by_median", replace_NaN_loop, (np.median,), replace_NaN_by_median, ()),
+    ]
+    for name, reference, reference_args, function, args in benchmarks:
+        t_ref, ref = timeit(reference, tX, *reference_args, repeat=repeat)
+        t_new, new = timeit(function, tX, *args, repeat=repeat)
+        assert np.allclose(ref, new)
+        print(f"  {name:22}: {t_ref:.3f}s -> {t_new:.3f}s ({t_ref / t_new:.1f}x)")
+
+
+def create_csv_submission_dictwriter(ids, y_pred, name):
+    """Reference writer with one csv.DictWriter.writerow call per prediction"""
+    with open(name, 'w') as csvfile:
+        fieldnames = ['Id', 'Prediction']
+        writer = csv.DictWriter(csvfile, delimiter=",", fieldnames=fieldnames)
+        writer.writeheader()
+        for r1, r2 in zip(ids, y_pred):
+            writer.writerow({'Id':int(r1),'Prediction':int(r2)})
+
+
+def benchmark_create_csv_submission(n=568238, repeat=3):
+    """
+    Compares create_csv_submission against the DictWriter reference writer.
+
+    :param n: number of predictions
+    :param repeat: number of repetitions
+    """
+
+    ids = np.arange(350000, 350000 + n)
+    y_pred = np.where(np.random.rand(n) < 0.5, -1., 1.)
+
+    with tempfile.TemporaryDirectory() as directory:
+        reference, bulk = os.path.join(directory, 'reference.csv'), os.path.join(directory, 'bulk.csv')
+
+        t_ref, _ = timeit(create_csv_submission_dictwriter, ids, y_pred, reference, repeat=repeat)
+        t_new, _ = timeit(create_csv_submission, ids, y_pred, bulk, repeat=repeat)
+        t_gz, _ = timeit(create_csv_submission, ids, y_pred, bulk + '.gz', repeat=repeat)
+
+        # the files must be byte-identical
+        with open(reference, 'rb') as f_ref, open(bulk, 'rb') as f_new:
+            assert f_ref.read() == f_new.read()
+
+    print(f"create_csv_submission ({n} rows)")
+    print(f"  DictWriter         : {t_ref:.3f}s")
+    print(f"  bulk               : {t_new:.3f}s ({t_ref / t_new:.1f}x)")
+    print(f"  bulk gzip          : {t_gz:.3f}s ({t_ref / t_gz:.1f}x)")
+
+
+def count_evaluations(model):
+    """Wraps the function object of a classifier to count its evaluations"""
+    function_object = model.function_object
+    model.evaluations = 0
+
+    def counted(*args):
+        model.evaluations += 1
+        return function_object(*args)
+
+    model.function_object = counted
+    return model
+
+
+def benchmark_solvers(y, tX, features, d_int=2, d_sq=1, max_evaluations=500):
+    """
+    Compares the convergence of the iterative solvers on the expanded jet splits.
+
+    :param y: labels
+    :param tX: data
+    :param features: feature names
+    :param d_int: degree of integer powers of the expansion
+    :param d_sq: degree of half-powers of the expansion
+    :param max_evaluations: maximum number of evaluations of every solver
+    """
+
+    _, X_split, y_split = Pipeline(features, d_int=d_int, d_sq=d_sq).fit_transform(tX, y)
+
+    print(f"solvers (build_X({d_int}, {d_sq}), at most {max_evaluations} evaluations)")
+    for i, (X, y_) in enumerate(zip(X_split, y_split)):
+        for name, classifier in [("LogisticRegression", LogisticRegression),
+                                 ("LogisticRegressionL2", lambda **kwargs: LogisticRegressionL2(1.0, **kwargs)),
+                                 ("LeastSquares", LeastSquares)]:
+            for solver_name in SOLVERS:
+                model = count_evaluations(classifier(max_evaluations=max_evaluations, solver=solver_name))
+                t, _ = timeit(model.fit, y_, X, repeat=1)
+                f, g = model.function_object(model.w, y_, X)
+                print(f"  split {i} {name:20} {solver_name:16}: {model.evaluations - 1:4d} evaluations, "
+                      f"{t:.2f}s, loss {f:.4f}, |g|inf {np.max(np.abs(g)):.1e}")
+
+
+def benchmark_SGD(y, tX, max_iters=600, gamma=0.05, batch_size=1024, epochs=2):
+    """
+    Compares full-batch gradient descent with mini-batch SGD on least squares.
+
+    :param y: labels
+    :param tX: data
+    :param max_iters: number of iterations of gradient descent
+    :param gamma: step size
+    :param batch_size: number of examples per batch of SGD
+    :param epochs: number of epochs of SGD
+    """
+
+    X = standardize(replace_NaN_by_median(tX))[0]
+    X = np.c_[np.ones(X.shape[0]), X]
+    w = np.zeros(X.shape[1])
+    n = X.shape[0]
+    sgd_iters = epochs * int(np.ceil(n / batch_size))
+
+    _, f_opt = least_squares(y, X)
+    t_gd, (_, f_gd) = timeit(least_squares_GD, y, X, w, max_iters, gamma, repeat=1)
+    t_sgd, (_, f_sgd) = timeit(least_squares_SGD, y, X, w, sgd_iters, gamma, batch_size=batch_size,
+                                schedule='inverse', momentum=0.5, seed=1, repeat=1)
+
+    print(f"least squares ({n} rows, optimum {f_opt:.5f})")
+    print(f"  GD, {max_iters} iterations    : {t_gd:.3f}s, loss {f_gd:.5f}, {max_iters * n / t_gd:.0f} rows/s")
+    print(f"  SGD, {epochs} epochs of {batch_size}-batches: {t_sgd:.3f}s, loss {f_sgd:.5f}, "
+          f"{epochs * n / t_sgd:.0f} rows/s")
+
+
+def log_reg_loss_function_reference(y, tx, w):
+    """Reference logistic loss with separate exponentials (overflows for large margins)"""
+    yXw = y * (tx @ w)
+    f = np.sum(np.log(1. + np.exp(-yXw)))
+    g = tx.T @ (- y / (1. + np.exp(yXw)))
+    return f, g
+
+
+def peak_allocation(function, *args):
+    """Peak memory allocated by a function call, in bytes"""
+    tracemalloc.start()
+    function(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak
+
+
+def benchmark_logistic_loss(n=250000, d=100, repeat=20):
+    """
+    Compares the fused logistic loss kernel with the reference implementation.
+
+    :param n: number of examples
+    :param d: number of features
+    :param repeat: number of evaluations
+    """
+
+    random = np.random.RandomState(1)
+    tx = random.randn(n, d)
+    y = np.where(random.rand(n) < 0.5, -1., 1.)
+    w = random.randn(d) / np.sqrt(d)
+    buffers = {}
+
+    # the first call allocates the buffers
+    log_reg_loss_function(y, tx, w, buffers)
+
+    t_ref, (f_ref, g_ref) = timeit(log_reg_loss_function_reference, y, tx, w, repeat=repeat)
+    t_new, (f_new, g_new) = timeit(log_reg_loss_function, y, tx, w, buffers, repeat=repeat)
+    assert np.isclose(f_ref, f_new) and np.allclose(g_ref, g_new)
+
+    m_ref = peak_allocation(log_reg_loss_function_reference, y, tx, w)
+    m_new = peak_allocation(log_reg_loss_function, y, tx, w, buffers)
+
+    print(f"logistic loss and gradient ({n}x{d})")
+    print(f"  reference          : {1000 * t_ref:.2f}ms, {m_ref / 2 ** 20:.1f}MB allocated")
+    print(f"  fused kernel       : {1000 * t_new:.2f}ms, {m_new / 2 ** 20:.1f}MB allocated")
+
+
+def fit_predict_submission(y, tX, tX_test, features, dtype=None, lambda_=3.5938136638046255e-12,
+                           d_int=10, d_sq=5, block_size=None):
+    """Trains the models of run.py in the given type (and block size) and predicts the test data"""
+    pipeline = Pipeline(features, 0.2, d_int, d_sq, dtype=dtype)
+    _, X_split, y_split = pipeline.fit_transform(tX, y, expand=False)
+    split_indices, X_test_split, _ = pipeline.transform(tX_test, expand=False)
+
+    y_pred = np.ones(tX_test.shape[0])
+    for X, y_, X_test, indices in zip(X_split, y_split, X_test_split, split_indices):
+        model = LeastSquaresL2(lambda_, expand=pipeline.expand, block_size=block_size)
+        model.fit(y_, X)
+        y_pred[indices] = model.predict(X_test)
+
+    return y_pred
+
+
+def benchmark_float32(data_path, ratio=0.8, repeat=1):
+    """
+    Compares the float32 mode of the run.py models with float64.
+
+    The data is loaded in both types, the models are trained on a part of it
+    and the predictions of the rest are compared with the labels and with the
+    float64 predictions.
+
+    :param data_path: path of the csv file
+    :param ratio: fraction of the rows used for training
+    :param repeat: number of repetitions
+    """
+
+    print("float32 mode (run.py models)")
+    y_pred = {}
+    for dtype in [np.float64, np.float32]:
+        y, tX, _, features = load_csv_data(data_path, dtype=dtype)
+        n_train = int(ratio * len(y))
+
+        arguments = (y[:n_train], tX[:n_train], tX[n_train:], features, None if dtype == np.float64 else dtype)
+        t, y_pred[dtype] = timeit(fit_predict_submission, *arguments, repeat=repeat)
+        memory = peak_allocation(fit_predict_submission, *arguments)
+
+        accuracy = np.mean(y_pred[dtype] == y[n_train:])
+        agreement = np.mean(y_pred[dtype] == y_pred[np.float64])
+        print(f"  {np.dtype(dtype).name:7}: {t:.2f}s, {memory / 2 ** 20:.0f}MB peak, "
+              f"accuracy {100 * accuracy:.2f}%, {100 * agreement:.2f}% same predictions as float64")
+
+
+def benchmark_block_size(data_path, block_sizes=(None, 10000, 1000), ratio=0.8, repeat=1):
+    """
+    Compares the blockwise normal equations of the run.py models (run.py --block-size) with the full expansion.
+
+    The rounding of the blockwise accumulation changes the weights of the
+    badly conditioned run.py models, so the agreement of the predictions of
+    the rest of the rows with the ones of the full expansion is reported.
+
+    :param data_path: path of the csv file
+    :param block_sizes: numbers of rows expanded at once (None for the full expanded matrices)
+    :param ratio: fraction of the rows used for training
+    :param repeat: number of repetitions
+    """
+
+    y, tX, _, features = load_csv_data(data_path)
+    n_train = int(ratio * len(y))
+
+    print("blockwise normal equations (run.py models)")
+    y_pred = {}
+    for block_size in block_sizes:
+        arguments = (y[:n_train], tX[:n_train], tX[n_train:], features)
+        function = functools.partial(fit_predict_submission, block_size=block_size)
+        t, y_pred[block_size] = timeit(function, *arguments, repeat=repeat)
+        memory = peak_allocation(function, *arguments)
+
+        accuracy = np.mean(y_pred[block_size] == y[n_train:])
+        agreement = np.mean(y_pred[block_size] == y_pred[block_sizes[0]])
+        print(f"  block size {block_size}: {t:.2f}s, {memory / 2 ** 20:.0f}MB peak, "
+              f"accuracy {100 * accuracy:.2f}%, {100 * agreement:.2f}% same predictions as block size {block_sizes[0]}")
+
+
+def benchmark_lasso(y, tX, features, d_int=3, d_sq=2, lambdas=np.logspace(-2, -4, 8), max_evaluations=500):
+    """
+    Compares proximal gradient descent with coordinate descent on a lasso path.
+
+    :param y: labels
+    :param tX: data
+    :param features: feature names
+    :param d_int: degree of integer powers of the expansion
+    :param d_sq: degree of half-powers of the expansion
+    :param lambdas: regularization strengths
+    :param max_evaluations: maximum number of evaluations of proximal gradient descent
+    """
+
+    pipeline = Pipeline(features, d_int=d_int, d_sq=d_sq)
+    _, X_split, y_split = pipeline.fit_transform(tX, y, expand=False)
+    X, y = X_split[1], y_split[1]
+    n = len(y)
+
+    t_gram, (G, b) = timeit(solver.normal_equations, y, X, pipeline.expand, repeat=1)
+    Q, c = G / n, b / n
+    loss = lambda w, lambda_: 0.5 * w.dot(Q @ w) - c.dot(w) + lambda_ * np.sum(np.abs(w))
+
+    def proximal_gradient(X_expanded):
+        models = [ LeastSquaresL1(lambda_, max_evaluations=max_evaluations, solver='gradient_descent')
+                   for lambda_ in lambdas ]
+        for model in models:
+            model.fit(y, X_expanded)
+        return np.array([ model.w for model in models ])
+
+    def coordinate_descent():
+        return np.array([ solver.lasso_coordinate_descent(Q, c, lambda_, max_evaluations=100000)[0]
+                          for lambda_ in lambdas ])
+
+    t_pg, W_pg = timeit(proximal_gradient, pipeline.expand(X), repeat=1)
+    t_cd, W_cd = timeit(coordinate_descent, repeat=1)
+    t_path, W_path = timeit(solver.lasso_path, G, b, n, lambdas, 100000, repeat=1)
+
+    print(f"lasso path (split 1, {n}x{G.shape[0]}, {len(lambdas)} lambdas, normal equations {t_gram:.2f}s)")
+    for name, t, W in [("proximal gradient", t_pg, W_pg), ("coordinate descent", t_cd, W_cd),
+                       ("warm-started path", t_path, W_path)]:
+        losses = " ".join(f"{loss(w, lambda_):.5f}" for w, lambda_ in zip(W, lambdas))
+        nonzeros = " ".join(f"{np.count_nonzero(w):3d}" for w in W)
+        print(f"  {name:18}: {t:.2f}s, losses {losses}")
+        print(f"  {'':18}  nonzero weights {nonzeros}")
+
+
+def benchmark_ridge_path(y, tX, features, d_int=10, d_sq=5,
+                         lambdas=(3.5938136638046255e-12, 1e-8, 1e-4, 1e-2)):
+    """
+    Checks the ridge path against a separate LeastSquaresL2.fit per lambda.
+
+    The default degrees are those of run.py, whose Gram matrices are too badly
+    conditioned for the eigendecomposition alone (see solver.ridge_path).
+
+    :param y: labels
+    :param tX: data
+    :param features: feature names
+    :param d_int: degree of integer powers of the expansion
+    :param d_sq: degree of half-powers of the expansion
+    :param lambdas: regularization strengths
+    """
+
+    pipeline = Pipeline(features, d_int=d_int, d_sq=d_sq)
+    _, X_split, y_split = pipeline.fit_transform(tX, y, expand=False)
+
+    print(f"ridge path (build_X({d_int}, {d_sq}))")
+    for i, (X, y_) in enumerate(zip(X_split, y_split)):
+        path = LeastSquaresL2(0, expand=pipeline.expand)
+        t_path, W = timeit(path.fit_path, y_, X, lambdas, repeat=1)
+        accuracies_path = np.mean(path.predict_path(X) == y_, axis=1)
+
+        t_fit = 0.
+        for lambda_, w, accuracy_path in zip(lambdas, W, accuracies_path):
+            model = LeastSquaresL2(lambda_, expand=pipeline.expand)
+            t, _ = timeit(model.fit, y_, X, repeat=1)
+            t_fit += t
+
+            difference = np.linalg.norm(w - model.w) / np.linalg.norm(model.w)
+            accuracy_fit = np.mean(model.predict(X) == y_)
+            print(f"  split {i} lambda {lambda_:.1e}: relative weight difference {difference:.1e}, "
+                  f"accuracy path {100 * accuracy_path:.2f}% / fit {100 * accuracy_fit:.2f}%")
+        print(f"  split {i}: path {t_path:.2f}s, separate fits {t_fit:.2f}s")
+
+
+def benchmark_grid_search(y, tX, features, d_ints=(2, 10), d_sqs=(1, 5), lambdas=(3.5938136638046255e-12, 1e-4),
+                          k_fold=4, n_jobs=2):
+    """
+    Checks the parallel grid search against serial cross-validation of one model per lambda.
+
+    :param y: labels
+    :param tX: data
+    :param features: feature names
+    :param d_ints: degrees of integer powers
+    :param d_sqs: degrees of half-powers
+    :param lambdas: regularization strengths
+    :param k_fold: number of folds
+    :param n_jobs: number of processes of the grid search
+    """
+
+    _, X_split, y_split = Pipeline(features).fit_transform(tX, y, expand=False)
+    sizes = np.array([ len(y_) for y_ in y_split ])
+
+    t_grid, (D_INT, D_SQ, LAMBDA, ACC) = timeit(parallel.grid_search_kfold, X_split, y_split, d_ints, d_sqs,
+                                                lambdas, k_fold, n_jobs, repeat=1)
+
+    print(f"grid search ({len(d_ints) * len(d_sqs) * len(lambdas)} cells, {n_jobs} processes, {t_grid:.2f}s)")
+    for index in np.ndindex(ACC.shape):
+        d_int, d_sq, lambda_ = D_INT[index], D_SQ[index], LAMBDA[index]
+        expand = functools.partial(build_X, d_int=d_int, d_sq=d_sq)
+        serial = np.dot(sizes / np.sum(sizes),
+                        [ np.mean(cross_validate_kfold(y_, X, LeastSquaresL2(lambda_, expand=expand), k_fold))
+                          for X, y_ in zip(X_split, y_split) ])
+        print(f"  build_X({d_int}, {d_sq}) lambda {lambda_:.1e}: grid {100 * ACC[index]:.2f}%, "
+              f"serial {100 * serial:.2f}%")
+
+
+def benchmark_out_of_core(data_path, chunk_sizes=(50000, 10000, 2000), lambda_=3.5938136638046255e-12,
+                          d_int=10, d_sq=5):
+    """
+    Compares the out-of-core models of run.py with the in-memory ones.
+
+    With build_X(X, 10, 5) the regularized normal equations have a condition
+    number around 1e31, so the rounding of the chunked accumulation changes
+    the weights completely: the agreement of the predictions is what is reported.
+
+    :param data_path: path of the csv file
+    :param chunk_sizes: numbers of rows read at once
+    :param lambda_: regularization strength
+    :param d_int: degree of integer powers of the expansion
+    :param d_sq: degree of half-powers of the expansion
+    """
+
+    y, tX, _, features = load_csv_data(data_path)
+    pipeline = Pipeline(features, 0.2, d_int, d_sq)
+    _, X_split, y_split = pipeline.fit_transform(tX, y, expand=False)
+
+    models = [ LeastSquaresL2(lambda_, expand=pipeline.expand) for _ in X_split ]
+    for model, X, y_ in zip(models, X_split, y_split):
+        model.fit(y_, X)
+
+    print(f"out-of-core fit (build_X({d_int}, {d_sq}), lambda {lambda_:.1e}, {len(y)} rows)")
+    for chunk_size in chunk_sizes:
+        pipeline_chunks = Pipeline(features, 0.2, d_int, d_sq)
+        t, models_chunks = timeit(streaming.fit_out_of_core, data_path, pipeline_chunks,
+                                  lambda: LeastSquaresL2(lambda_, expand=pipeline_chunks.expand), chunk_size, repeat=1)
+
+        agreement = 0
+        for i, (model, model_chunks, X, y_) in enumerate(zip(models, models_chunks, X_split, y_split)):
+            y_pred, y_pred_chunks = model.predict(X), model_chunks.predict(X)
+            agreement += np.sum(y_pred == y_pred_chunks)
+
+            difference = np.linalg.norm(model_chunks.w - model.w) / np.linalg.norm(model.w)
+            print(f"  chunks of {chunk_size} split {i}: relative weight difference {difference:.1e}, "
+                  f"accuracy {100 * np.mean(y_pred == y_):.2f}% in memory / "
+                  f"{100 * np.mean(y_pred_chunks == y_):.2f}% out-of-core")
+        print(f"  chunks of {chunk_size}: {t:.2f}s, {100 * agreement / len(y):.2f}% same predictions as in memory")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmarks of the training and scoring pipeline")
+    parser.add_argument("--data", default="../data/train.csv", help="csv file used by the benchmarks")
+    parser.add_argument("--test-data", default="../data/test.csv", help="csv file split by benchmark_split_data")
+    parser.add_argument("--repeat", type=int, default=3, help="number of repetitions per benchmark")
+    args = parser.parse_args()
+
+    benchmark_load_csv_data(args.data, args.repeat)
+
+    _, tX, _, _ = load_csv_data(args.data)
+    benchmark_nan_handling(tX, args.repeat)
+
+    _, tX_test, _, features = load_csv_data(args.test_data)
+    benchmark_split_data(tX_test, features, args.repeat)
+
+    benchmark_create_csv_submission(repeat=args.repeat)
+
+    y, tX, _, features = load_csv_data(args.data)
+    benchmark_solvers(y, tX, features)
+    benchmark_SGD(y, tX)
+    benchmark_logistic_loss(repeat=args.repeat)
+    benchmark_float32(args.data)
+    benchmark_block_size(args.data)
+    benchmark_lasso(y, tX, features)
+    benchmark_ridge_path(y, tX, features)
+    benchmark_grid_search(y, tX, features)
+    benchmark_out_of_core(args.data)
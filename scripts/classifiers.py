@@ -1,26 +1,46 @@
 # -*- coding: utf-8 -*-
 """Classifiers"""
 
+import inspect
+import json
+import os
 import numpy as np
 import math
 import solver
-from implementations import log_1_plus_exp_safe
+from implementations import log_reg_loss_function
+from dataprocessing import Pipeline
+from instrumentation import instrumented
+
+
+# iterative solvers that can be chosen with the solver argument of the classifiers
+SOLVERS = {
+    'gradient_descent': solver.gradient_descent,
+    'lbfgs': solver.lbfgs,
+    'newton': solver.newton,
+}
 
 
 class LeastSquares:
     """Least squares classifier"""
 
-    def __init__(self, verbose=False, max_evaluations=100):
+    def __init__(self, verbose=False, max_evaluations=100, expand=None, block_size=None, solver=None):
         """
         Constructor
 
         :param verbose: print out information
         :param max_evaluations: maximum number of evaluations
+        :param expand: feature expansion applied to the data before fitting and predicting
+        :param block_size: number of rows expanded at once (None to expand all rows at once)
+        :param solver: iterative solver ('gradient_descent', 'lbfgs', 'newton'), None to solve the normal equations
         """
 
         self.verbose = verbose
         self.max_evaluations = max_evaluations
+        self.expand = expand
+        self.block_size = block_size
+        self.solver = solver
 
+    @instrumented
     def fit(self, y, X):
         """
         Finds weights to fit the data to the model
@@ -29,14 +49,57 @@ class LeastSquares:
         :param X: data
         """
 
-        # dimensions
-        n, d = X.shape
+        if self.solver is not None:
+            if self.expand is not None:
+                X = self.expand(X)
 
-        # initial weight vector
-        self.w = np.zeros(d)
+            # fit weights iteratively
+            self.w, f = SOLVERS[self.solver](self.function_object, np.zeros(X.shape[1]),
+                                             self.max_evaluations, y, X, verbose=self.verbose,
+                                             **self.solver_options())
+            return
+
+        # normal equations, accumulated block by block if needed
+        G, b = solver.normal_equations(y, X, self.expand, self.block_size)
 
         # find weights
-        self.w = np.linalg.solve(X.T @ X, X.T @ y)
+        self.fit_normal_equations(G, b, X.shape[0])
+
+    @instrumented
+    def fit_chunks(self, chunks):
+        """
+        Finds weights from training data read chunk by chunk
+
+        The normal equations are accumulated chunk by chunk (whatever the solver),
+        which gives the normal equations of fit on the whole data up to rounding
+        while memory only depends on the chunk size. For badly conditioned
+        systems (e.g. the build_X(X, 10, 5) expansion of run.py) that rounding
+        is enough to change the weights, only the predictions agree closely
+        (see benchmark_out_of_core in benchmarks.py).
+
+        :param chunks: function returning a new iterator of (y, X) chunks at every call
+        """
+
+        G, b, n = 0., 0., 0
+        for y, X in chunks():
+            if len(y):
+                G_chunk, b_chunk = solver.normal_equations(y, X, self.expand, self.block_size)
+                G, b, n = G + G_chunk, b + b_chunk, n + len(y)
+
+        # find weights
+        self.fit_normal_equations(G, b, n)
+
+    @instrumented
+    def fit_normal_equations(self, G, b, n):
+        """
+        Finds weights from already computed normal equations
+
+        :param G: Gram matrix X.T @ X
+        :param b: moment vector X.T @ y
+        :param n: number of examples
+        """
+
+        self.w = np.linalg.solve(G, b)
 
 
     def function_object(self, w, y, X):
@@ -52,17 +115,41 @@ class LeastSquares:
         # dimensions
         n, d = X.shape
 
-        # compute error
-        e = y - X @ w
+        # compute error, the products are computed in the type of the data (e.g. float32)
+        e = np.subtract(y, X @ w.astype(X.dtype, copy=False), dtype=X.dtype)
 
         # compute loss
-        f = 1/(2 * n) * np.sum(e ** 2)
+        f = 1/(2 * n) * np.sum(e ** 2, dtype=np.float64)
 
         # compute gradient
-        g = - 1 / n * X.T @ e
+        g = - 1 / n * (X.T @ e).astype(np.float64, copy=False)
 
         return f, g
 
+    def hessian(self, w, y, X):
+        """
+        Hessian of the function object.
+
+        :param w: weights
+        :param y: answers
+        :param X: data
+        :return: Hessian matrix
+        """
+
+        G, _ = solver.normal_equations(y, X)
+
+        return G / X.shape[0]
+
+    def solver_options(self):
+        """
+        Additional arguments of the iterative solver
+
+        :return: keyword arguments
+        """
+
+        return {'hessian': self.hessian} if self.solver == 'newton' else {}
+
+    @instrumented
     def predict(self, X):
         """
         Predict
@@ -71,40 +158,92 @@ class LeastSquares:
         :return: answer prediction
         """
 
-        return np.sign(X @ self.w)
+        return np.sign(solver.block_matmul(X, self.w, self.expand, self.block_size))
 
     
 class LeastSquaresL2(LeastSquares):
     """L2-regularized Least Squares"""
     
-    def __init__(self, lambda_, verbose=False, max_evaluations=100):
+    def __init__(self, lambda_, verbose=False, max_evaluations=100, expand=None, block_size=None, solver=None):
         """
         Constructor
 
         :param lambda: regularization strength
         :param verbose: print out information
         :param max_evaluations: maximum number of evaluations
+        :param expand: feature expansion applied to the data before fitting and predicting
+        :param block_size: number of rows expanded at once (None to expand all rows at once)
+        :param solver: iterative solver ('gradient_descent', 'lbfgs', 'newton'), None to solve the normal equations
         """
         
         self.lambda_ = lambda_
-        super().__init__(verbose, max_evaluations)
+        super().__init__(verbose, max_evaluations, expand, block_size, solver)
     
-    def fit(self, y, X):
+    @instrumented
+    def fit_normal_equations(self, G, b, n):
         """
-        Finds weights to fit the data to the model
+        Finds weights from already computed normal equations
+
+        :param G: Gram matrix X.T @ X
+        :param b: moment vector X.T @ y
+        :param n: number of examples
+        """
+
+        # dimensions
+        d = G.shape[0]
+
+        # find weights
+        self.w = np.linalg.solve(G + n * self.lambda_ * np.eye(d), b)
+
+    @instrumented
+    def fit_path(self, y, X, lambdas):
+        """
+        Finds weights for a whole grid of regularization strengths
+
+        The Gram matrix is built and factorized only once (see solver.ridge_path).
+        The weights are stored in self.w_path, one row per lambda.
 
         :param y: answers
         :param X: data
+        :param lambdas: regularization strengths
+        :return: weights, one row per lambda
         """
 
         # dimensions
-        n, d = X.shape
+        n = X.shape[0]
 
-        # initial weight vector
-        self.w = np.zeros(d)
+        # normal equations, accumulated block by block if needed
+        G, b = solver.normal_equations(y, X, self.expand, self.block_size)
 
-        # find weights
-        self.w = np.linalg.solve(X.T @ X + n * self.lambda_ * np.eye(d), X.T @ y)
+        # find weights for every lambda
+        return self.fit_path_normal_equations(G, b, n, lambdas)
+
+    @instrumented
+    def fit_path_normal_equations(self, G, b, n, lambdas):
+        """
+        Finds weights for a grid of regularization strengths from already computed normal equations
+
+        :param G: Gram matrix X.T @ X
+        :param b: moment vector X.T @ y
+        :param n: number of examples
+        :param lambdas: regularization strengths
+        :return: weights, one row per lambda
+        """
+
+        self.w_path = solver.ridge_path(G, b, n, lambdas)
+
+        return self.w_path
+
+    @instrumented
+    def predict_path(self, X):
+        """
+        Predict with the weights of every lambda of the last fit_path
+
+        :param X: data
+        :return: answer predictions, one row per lambda
+        """
+
+        return np.sign(solver.block_matmul(X, self.w_path.T, self.expand, self.block_size)).T
         
     def function_object(self, w, y, X):
         """
@@ -123,23 +262,40 @@ class LeastSquaresL2(LeastSquares):
         g += self.lambda_ * w
 
         return f, g
+
+    def hessian(self, w, y, X):
+        """
+        Hessian of the function object.
+
+        :param w: weights
+        :param y: answers
+        :param X: data
+        :return: Hessian matrix
+        """
+
+        return super().hessian(w, y, X) + self.lambda_ * np.eye(len(w))
     
     
 class LeastSquaresL1(LeastSquares):
     """L1-regularized Least Squares"""
     
-    def __init__(self, lambda_, verbose=False, max_evaluations=100):
+    def __init__(self, lambda_, verbose=False, max_evaluations=100, expand=None, block_size=None, solver=None):
         """
         Constructor
 
         :param lambda: regularization strength
         :param verbose: print out information
-        :param max_evaluations: maximum number of evaluations
+        :param max_evaluations: maximum number of evaluations (sweeps of coordinate descent)
+        :param expand: feature expansion applied to the data before fitting and predicting
+        :param block_size: number of rows expanded at once (None to expand all rows at once)
+        :param solver: None for coordinate descent on the normal equations, 'gradient_descent' for
+                       proximal gradient descent on the data
         """
         
         self.lambda_ = lambda_
-        super().__init__(verbose, max_evaluations)
+        super().__init__(verbose, max_evaluations, expand, block_size, solver)
     
+    @instrumented
     def fit(self, y, X):
         """
         Finds weights to fit the data to the model
@@ -148,6 +304,16 @@ class LeastSquaresL1(LeastSquares):
         :param X: data
         """
 
+        if self.solver is None:
+            # coordinate descent on the normal equations (see fit_normal_equations)
+            return super().fit(y, X)
+
+        if self.solver != 'gradient_descent':
+            raise ValueError(f"LeastSquaresL1 cannot be fit with solver {self.solver}")
+
+        if self.expand is not None:
+            X = self.expand(X)
+
         # dimensions
         n, d = X.shape
 
@@ -157,23 +323,90 @@ class LeastSquaresL1(LeastSquares):
         # fit weights
         self.w, f = solver.gradient_descent_L1(self.function_object, self.w, self.lambda_,
                                                self.max_evaluations, y, X, verbose=self.verbose)
+
+    @instrumented
+    def fit_normal_equations(self, G, b, n):
+        """
+        Finds weights from already computed normal equations by coordinate descent
+
+        :param G: Gram matrix X.T @ X
+        :param b: moment vector X.T @ y
+        :param n: number of examples
+        """
+
+        self.w, f = solver.lasso_coordinate_descent(G / n, b / n, self.lambda_,
+                                                    max_evaluations=self.max_evaluations, verbose=self.verbose)
+
+    @instrumented
+    def fit_path(self, y, X, lambdas):
+        """
+        Finds weights for a whole grid of regularization strengths
+
+        The normal equations are computed only once and every lambda is warm
+        started from the solution of the previous, larger one (see solver.lasso_path).
+        The weights are stored in self.w_path, one row per lambda.
+
+        :param y: answers
+        :param X: data
+        :param lambdas: regularization strengths
+        :return: weights, one row per lambda
+        """
+
+        # normal equations, accumulated block by block if needed
+        G, b = solver.normal_equations(y, X, self.expand, self.block_size)
+
+        # find weights for every lambda
+        return self.fit_path_normal_equations(G, b, X.shape[0], lambdas)
+
+    @instrumented
+    def fit_path_normal_equations(self, G, b, n, lambdas):
+        """
+        Finds weights for a grid of regularization strengths from already computed normal equations
+
+        :param G: Gram matrix X.T @ X
+        :param b: moment vector X.T @ y
+        :param n: number of examples
+        :param lambdas: regularization strengths
+        :return: weights, one row per lambda
+        """
+
+        self.w_path = solver.lasso_path(G, b, n, lambdas, self.max_evaluations, verbose=self.verbose)
+
+        return self.w_path
+
+    @instrumented
+    def predict_path(self, X):
+        """
+        Predict with the weights of every lambda of the last fit_path
+
+        :param X: data
+        :return: answer predictions, one row per lambda
+        """
+
+        return np.sign(solver.block_matmul(X, self.w_path.T, self.expand, self.block_size)).T
     
 
     
 class LogisticRegression:
     """Logistic Regression"""
 
-    def __init__(self, verbose=False, max_evaluations=100):
+    def __init__(self, verbose=False, max_evaluations=100, solver='gradient_descent'):
         """
         Constructor
 
         :param verbose: print out information
         :param max_evaluations: maximum number of evaluations
+        :param solver: iterative solver ('gradient_descent', 'lbfgs', 'newton')
         """
 
         self.verbose = verbose
         self.max_evaluations = max_evaluations
+        self.solver = solver
 
+        # work arrays of the loss function
+        self.buffers = {}
+
+    @instrumented
     def fit(self, y, X):
         """
         Finds weights to fit the data to the model
@@ -189,8 +422,42 @@ class LogisticRegression:
         self.w = np.zeros(d)
 
         # fit weights
-        self.w, f = solver.gradient_descent(self.function_object, self.w, 
-                                            self.max_evaluations, y, X, verbose=self.verbose)
+        self.w, f = self.minimize(self.function_object, self.hessian, self.w, y, X)
+
+    @instrumented
+    def fit_chunks(self, chunks):
+        """
+        Finds weights from training data read chunk by chunk
+
+        Every evaluation of the loss (and of the Hessian) is a streaming pass
+        over the chunks, so the solver takes the same steps as fit on the whole
+        data (up to rounding) while memory only depends on the chunk size.
+
+        :param chunks: function returning a new iterator of (y, X) chunks at every call
+        """
+
+        # dimensions
+        y, X = next(iter(chunks()))
+        d = X.shape[1]
+
+        # fit weights
+        self.w, f = self.minimize(self.function_object_chunks, self.hessian_chunks, np.zeros(d), chunks)
+
+    def minimize(self, function_object, hessian, w, *args):
+        """
+        Runs the iterative solver
+
+        :param function_object: loss function that returns loss and gradient
+        :param hessian: Hessian of the loss function (used by newton)
+        :param w: initial weights
+        :param args: additional arguments of the functions (y, X or chunks)
+        :return: weights, loss
+        """
+
+        options = {'hessian': hessian} if self.solver == 'newton' else {}
+
+        return SOLVERS[self.solver](function_object, w, self.max_evaluations, *args,
+                                    verbose=self.verbose, **options)
 
     def function_object(self, w, y, X):
         """
@@ -202,17 +469,95 @@ class LogisticRegression:
         :return: loss, gradient
         """
 
-        pred = y * X.dot(w)
+        # shared stable kernel, work arrays are reused across the solver iterations
+        f, g = log_reg_loss_function(y, X, w, self.buffers)
 
-        # function value
-        f = np.sum(log_1_plus_exp_safe(-pred))
+        # add regularization
+        f_reg, g_reg = self.regularization(w)
 
-        # gradient value
-        res = - y / (1. + np.exp(pred))
-        g = X.T.dot(res)
+        return f + f_reg, g + g_reg
+
+    def function_object_chunks(self, w, chunks):
+        """
+        Function Object summed over chunks of data.
+
+        :param w: weights
+        :param chunks: function returning a new iterator of (y, X) chunks
+        :return: loss, gradient
+        """
+
+        f, g = self.regularization(w)
+        for y, X in chunks():
+            f_chunk, g_chunk = log_reg_loss_function(y, X, w, self.buffers)
+            f, g = f + f_chunk, g + g_chunk
 
         return f, g
 
+    def regularization(self, w):
+        """
+        Regularization term of the function object.
+
+        :param w: weights
+        :return: loss, gradient
+        """
+
+        return 0., 0.
+
+    def hessian(self, w, y, X):
+        """
+        Hessian of the function object.
+
+        :param w: weights
+        :param y: answers
+        :param X: data
+        :return: Hessian matrix
+        """
+
+        return self.loss_hessian(w, y, X) + self.regularization_hessian(w)
+
+    def hessian_chunks(self, w, chunks):
+        """
+        Hessian of the function object summed over chunks of data.
+
+        :param w: weights
+        :param chunks: function returning a new iterator of (y, X) chunks
+        :return: Hessian matrix
+        """
+
+        H = self.regularization_hessian(w)
+        for y, X in chunks():
+            H = H + self.loss_hessian(w, y, X)
+
+        return H
+
+    def loss_hessian(self, w, y, X):
+        """
+        Hessian of the logistic loss, accumulated block by block.
+
+        :param w: weights
+        :param y: answers
+        :param X: data
+        :return: Hessian matrix
+        """
+
+        pred = y * X.dot(w.astype(X.dtype, copy=False))
+
+        # sigma(pred) * (1 - sigma(pred)), computed without overflow
+        s = np.exp(-np.logaddexp(0., pred) - np.logaddexp(0., -pred))
+
+        return solver.weighted_gram(X, s)
+
+    def regularization_hessian(self, w):
+        """
+        Hessian of the regularization term.
+
+        :param w: weights
+        :return: Hessian matrix
+        """
+
+        return 0.
+
+    @instrumented
     def predict(self, X):
         """
         Predict
@@ -221,42 +566,44 @@ class LogisticRegression:
         :return: answer prediction
         """
 
-        return np.sign(X @ self.w)
+        return np.sign(solver.block_matmul(X, self.w))
 
     
 class LogisticRegressionL2(LogisticRegression):
     """L2-regularized Logistic Regression"""
 
-    def __init__(self, lambda_=1.0, verbose=False, max_evaluations=100):
+    def __init__(self, lambda_=1.0, verbose=False, max_evaluations=100, solver='gradient_descent'):
         """
         Constructor
 
-        :param lambda_: lambda of L1 regularization
+        :param lambda_: lambda of L2 regularization
         :param verbose: print out information
         :param max_evaluations: maximum number of evaluations
+        :param solver: iterative solver ('gradient_descent', 'lbfgs', 'newton')
         """
         
-        self.verbose = verbose
-        self.max_evaluations = max_evaluations
+        super().__init__(verbose, max_evaluations, solver)
         self.lambda_ = lambda_
 
-    def funObj(self, w, y, X):
+    def regularization(self, w):
         """
-        Function Object
+        L2 regularization
 
         :param w: weight
-        :param y: answers
-        :param X: data
         :return: loss, gradient
         """
-        # Obtain normal loss and gradient using the superclass
-        f, g = super().funObj(w, y, X)
 
-        # Add L2 regularization
-        f += self.lambda_ / 2. * w.dot(w)
-        g += self.lambda_ * w
+        return self.lambda_ / 2. * w.dot(w), self.lambda_ * w
 
-        return f, g
+    def regularization_hessian(self, w):
+        """
+        Hessian of the L2 regularization
+
+        :param w: weight
+        :return: Hessian matrix
+        """
+
+        return self.lambda_ * np.eye(len(w))
 
     
 class LogisticRegressionL1(LogisticRegression):
@@ -266,31 +613,119 @@ class LogisticRegressionL1(LogisticRegression):
         """
         Constructor
 
-        :param lambda_: lambda of L2 regularization
+        :param lambda_: lambda of L1 regularization
         :param verbose: print out information
         :param max_evaluations: maximum number of evaluations
         """
         
-        self.verbose = verbose
-        self.max_evaluations = max_evaluations
+        super().__init__(verbose, max_evaluations)
         self.lambda_ = lambda_
        
         
-    def fit(self, y, X):
+    def minimize(self, function_object, hessian, w, *args):
         """
-        Finds weights to fit the data to the model
+        Runs proximal gradient descent (the L1 term is handled by the solver)
 
-        :param y: answers
-        :param X: data
+        :param function_object: loss function that returns loss and gradient
+        :param hessian: unused
+        :param w: initial weights
+        :param args: additional arguments of the function object (y, X or chunks)
+        :return: weights, loss
         """
 
-        # dimensions
-        n, d = X.shape
+        return solver.gradient_descent_L1(function_object, w, self.lambda_,
+                                          self.max_evaluations, *args, verbose=self.verbose)
 
-        # initial weight vector
-        self.w = np.zeros(d)
 
-        # fit weights
-        self.w, f = solver.gradient_descent_L1(self.function_object, self.w, self.lambda_,
-                                               self.max_evaluations, y, X, verbose=self.verbose)
-    
\ No newline at end of file
+
+###########################
+# Model artifacts
+###########################
+
+# constructor parameters stored with the weights
+MODEL_PARAMS = ['lambda_', 'verbose', 'max_evaluations', 'block_size', 'solver']
+
+
+@instrumented
+def save_models(directory, models, pipeline=None):
+    """
+    Saves trained classifiers (e.g. one per split) and their preprocessing.
+
+    Every array is stored as a .npy file so that load_models can memory map
+    them, and meta.json describing the classifiers is written last. It lists
+    the files of the weights and the keys of the pipeline state, so that the
+    files left by a previous artifact saved in the same directory are ignored.
+
+    :param directory: directory of the artifact
+    :param models: trained classifiers
+    :param pipeline: fitted dataprocessing.Pipeline (optional)
+    """
+
+    os.makedirs(directory, exist_ok=True)
+
+    meta = {'models': [], 'pipeline': None}
+    for i, model in enumerate(models):
+        np.save(os.path.join(directory, f'w_{i}.npy'), model.w)
+        meta['models'].append({
+            'class': type(model).__name__,
+            'weights': f'w_{i}.npy',
+            'params': { key: getattr(model, key) for key in MODEL_PARAMS
+                        if hasattr(model, key) and key in inspect.signature(type(model)).parameters },
+            'expand': getattr(model, 'expand', None) is not None,
+        })
+
+    if pipeline is not None:
+        meta['pipeline'] = []
+        for key, array in pipeline.state().items():
+            np.save(os.path.join(directory, f'pipeline_{key}.npy'), array)
+            meta['pipeline'].append(key)
+
+    with open(os.path.join(directory, 'meta.json'), 'w') as f:
+        # numpy scalars are stored as python scalars
+        json.dump(meta, f, indent=1, default=lambda x: x.item())
+
+
+@instrumented
+def load_models(directory, mmap_mode='r'):
+    """
+    Loads classifiers saved with save_models.
+
+    Classifiers that expanded their data are given the expand function of
+    the loaded pipeline.
+
+    :param directory: directory of the artifact
+    :param mmap_mode: memory map mode of the arrays (None to read them in memory)
+    :return: classifiers, pipeline (None if none was saved)
+    """
+
+    with open(os.path.join(directory, 'meta.json')) as f:
+        meta = json.load(f)
+
+    # artifacts saved before the keys were listed only flag the pipeline
+    keys = meta['pipeline']
+    if keys is False:
+        keys = None
+    elif keys is True:
+        keys = [ filename[len('pipeline_'):-len('.npy')] for filename in os.listdir(directory)
+                 if filename.startswith('pipeline_') and filename.endswith('.npy') ]
+
+    pipeline = None
+    if keys is not None:
+        state = { key: np.load(os.path.join(directory, f'pipeline_{key}.npy'), mmap_mode=mmap_mode) for key in keys }
+        pipeline = Pipeline.from_state(state)
+
+    models = []
+    for i, description in enumerate(meta['models']):
+        model = CLASSIFIERS[description['class']](**description['params'])
+        weights = description.get('weights', f'w_{i}.npy')
+        model.w = np.load(os.path.join(directory, weights), mmap_mode=mmap_mode)
+        if description['expand']:
+            model.expand = pipeline.expand
+        models.append(model)
+
+    return models, pipeline
+
+
+CLASSIFIERS = { cls.__name__: cls for cls in [
+    LeastSquares, LeastSquaresL2, LeastSquaresL1, LogisticRegression, LogisticRegressionL2, LogisticRegressionL1
+] }
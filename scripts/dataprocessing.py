@@ -1,92 +1,249 @@
 # -*- coding: utf-8 -*-
 """Feature Engineering and Model Selection"""
 
+import functools
 import numpy as np
 import math
+import solver
+from instrumentation import instrumented
 
 
-def standardize(x, mean=None, std=None):
+class RunningStatistics:
+    """
+    Mergeable mean and standard deviation of the columns of data seen chunk by chunk
+
+    Holds the count, mean and sum of squared deviations from the mean (M2) of
+    every column. Chunks are added with update, and the statistics of separate
+    chunks, workers or processes are merged with combine (Chan et al.), so that
+    no second pass over the data is needed. Values equal to missing (e.g. -999)
+    can be left out of the statistics of their column.
+    """
+
+    def __init__(self, d, missing=None):
+        """
+        Constructor
+
+        :param d: number of columns
+        :param missing: value of the missing entries left out of the statistics (None to use all values)
+        """
+
+        self.missing = missing
+        self.count = np.zeros(d, dtype=np.int64)
+        self.mean = np.zeros(d)
+        self.M2 = np.zeros(d)
+
+    @classmethod
+    def from_data(cls, x, missing=None):
+        """
+        Statistics of a data matrix
+
+        :param x: data
+        :param missing: value of the missing entries left out of the statistics
+        :return: statistics
+        """
+
+        return cls(x.shape[1], missing).update(x)
+
+    def update(self, x):
+        """
+        Adds a chunk of rows
+
+        :param x: chunk of data
+        :return: self
+        """
+
+        if x.shape[0] == 0:
+            return self
+
+        if self.missing is None:
+            count = np.full(x.shape[1], x.shape[0])
+            mean = np.mean(x, axis=0, dtype=np.float64)
+            M2 = np.sum((x - mean) ** 2, axis=0)
+        else:
+            present = x != self.missing
+            count = np.count_nonzero(present, axis=0)
+            mean = np.divide(np.sum(x, axis=0, where=present, dtype=np.float64), count,
+                             out=np.zeros(x.shape[1]), where=count > 0)
+            M2 = np.sum((x - mean) ** 2, axis=0, where=present)
+
+        return self._merge(count, mean, M2)
+
+    def combine(self, other):
+        """
+        Statistics of the data of both objects (e.g. of two chunks or processes)
+
+        :param other: statistics of other rows of the same columns
+        :return: new statistics
+        """
+
+        result = RunningStatistics(len(self.mean), self.missing)
+        result.count, result.mean, result.M2 = self.count.copy(), self.mean.copy(), self.M2.copy()
+
+        return result._merge(other.count, other.mean, other.M2)
+
+    def _merge(self, count, mean, M2):
+        """Merges the statistics of other rows into self"""
+        total = self.count + count
+        delta = mean - self.mean
+
+        # columns without any value keep zero statistics
+        weight = np.divide(count, total, out=np.zeros(len(total)), where=total > 0)
+
+        self.mean = self.mean + delta * weight
+        self.M2 = self.M2 + M2 + delta ** 2 * (self.count * weight)
+        self.count = total
+
+        return self
+
+    def std(self):
+        """
+        Standard deviation (of the population, like np.std)
+
+        :return: standard deviation of every column (NaN for columns without values)
+        """
+
+        return np.sqrt(np.divide(self.M2, self.count, out=np.full(len(self.M2), np.nan), where=self.count > 0))
+
+    def scale(self):
+        """
+        Standard deviation used to standardize, 1 for constant columns (or columns
+        without values) so that they are standardized to 0 instead of NaN.
+
+        :return: scale of every column
+        """
+
+        std = self.std()
+
+        return np.where(std > 0, std, 1.)
+
+    def transform(self, x, out=None, dtype=None):
+        """
+        Standardizes data with the statistics, missing values being replaced by 0 (the mean)
+
+        :param x: data
+        :param out: preallocated array of the shape of x (e.g. x itself to standardize in place)
+        :param dtype: type of the standardized data if out is not given (float64 by default)
+        :return: standardized data
+        """
+
+        if out is None:
+            out = np.empty(x.shape, dtype=np.float64 if dtype is None else dtype)
+
+        missing = None if self.missing is None else x == self.missing
+
+        np.subtract(x, self.mean, out=out)
+        out /= self.scale()
+
+        if missing is not None:
+            out[missing] = 0.
+
+        return out
+
+
+@instrumented
+def standardize(x, mean=None, std=None, dtype=None):
     """
     Standardizes a data matrix.
 
+    The mean and standard deviation are always computed in float64 (see
+    RunningStatistics), dtype only sets the type of the standardized data
+    (e.g. np.float32 to halve its size). Constant columns get a standard
+    deviation of 1 and are standardized to 0.
+
     :param x: data
     :param mean: mean used for standardization
     :param std: standard deviation used for standardization
+    :param dtype: type of the standardized data (float64 by default)
     :return: standardized data
     """
 
-    if mean is None:
-        mean = np.mean(x, axis=0)
+    if mean is None or std is None:
+        statistics = RunningStatistics.from_data(x)
+        mean = statistics.mean if mean is None else mean
+        std = statistics.scale() if std is None else std
 
-    if std is None:
-        std = np.std(x, axis=0)
+    # subtract and divide in a single output array
+    result = np.subtract(x, mean, dtype=dtype)
+    result /= std
 
-    return (x - mean) / std, mean, std
+    return result, mean, std
 
 
-def remove_NaN_features(x, threshold=0.0):
+@instrumented
+def remove_NaN_features(x, threshold=0.0, columns=None, return_columns=False):
     """
     Removes the feature if it has more than a certain percentage of -999 values.
 
+    The kept columns can be returned and given back to project other data
+    (e.g. test data) on the same columns.
+
     :param x: data
-    :param threshold: data
-    """
-    n, d = x.shape
-    result = []
-    X = x.copy()
-
-    for j in range(d):
-        # get examples where the feature j is NaN
-        positions = X[:, j] == -999
-        if np.mean(positions) < threshold:
-            if not len(result):
-                result = X[:, j]
-            else:
-                result = np.c_[result, X[:, j]]
+    :param threshold: maximum fraction of -999 values of a kept feature
+    :param columns: indices of the columns to keep (computed from x if None)
+    :param return_columns: also return the indices of the kept columns
+    :return: data without the removed features (, indices of the kept columns)
+    """
+
+    if columns is None:
+        # fraction of NaN of every feature in a single pass
+        columns = np.flatnonzero(np.mean(x == -999, axis=0) < threshold)
+
+    # take (unlike fancy indexing) returns a C-ordered array, like the original data
+    result = x.take(columns, axis=1)
+
+    if return_columns:
+        return result, columns
 
     return result
 
 
+@instrumented
 def replace_NaN_by_mean(x):
     """
     Replaces the -999 values of x by the mean of that feature vector.
 
     :param x: data
     """
-    
-    n, d = x.shape
-    result = x.copy()
 
-    for j in range(d):
-        # get examples where the feature j is NaN
-        positions = result[:, j] == -999
-        if np.sum(positions) > 0:
-            # replace NaN values by mean based on non-NaN examples
-            result[positions] = np.mean(result[~positions, j])
+    positions = x == -999
 
-    return result
+    # mean of every feature based on non-NaN examples
+    mean = np.sum(np.where(positions, 0, x), axis=0) / np.sum(~positions, axis=0)
+
+    return np.where(positions, mean, x)
 
 
+@instrumented
 def replace_NaN_by_median(x):
     """
     Replaces the -999 values of x by the median of that feature vector
 
     :param x: data
     """
-    
-    n, d = x.shape
+
+    positions = x == -999
     result = x.copy()
 
-    for j in range(d):
-        # get examples where the feature j is NaN
-        positions = result[:, j] == -999
-        if np.sum(positions) > 0:
-            # replace NaN values by mean based on non-NaN examples
-            result[positions] = np.median(result[~positions, j])
+    # only features with NaN values need a median
+    columns = np.flatnonzero(np.any(positions, axis=0))
+    if len(columns):
+        positions = positions[:, columns]
+        count = np.sum(~positions, axis=0)
+
+        # sort every feature at once, NaN values last
+        sorted_x = np.sort(np.where(positions, np.inf, x[:, columns]), axis=0)
+
+        # median based on non-NaN examples
+        low = np.take_along_axis(sorted_x, (count - 1)[None, :] // 2, axis=0)[0]
+        high = np.take_along_axis(sorted_x, count[None, :] // 2, axis=0)[0]
+        median = np.where(count > 0, (low + high) / 2, np.nan)
+
+        result[:, columns] = np.where(positions, median, x[:, columns])
 
     return result
 
 
+@instrumented
 def remove_features(data, features, feats):
     """
     This function removes features from the data and the features list.
@@ -108,6 +265,7 @@ def remove_features(data, features, feats):
     return np.delete(data, idx_to_remove, 1), np.delete(features, idx_to_remove)
 
 
+@instrumented
 def binarize_undefined(data, features, feats):
     """
     Additive Binarization of NaNs in a database.
@@ -139,6 +297,7 @@ def binarize_undefined(data, features, feats):
     return data, features
             
             
+@instrumented
 def cross_validate(y, tx, classifier, ratio, n_iter):
     """
     Cross-validate classifier.
@@ -180,6 +339,7 @@ def cross_validate(y, tx, classifier, ratio, n_iter):
     return accuracy
 
 
+@instrumented
 def build_k_indices(y, k_fold, seed=1):
     """build k indices for k-fold cross-validation."""
     
@@ -191,17 +351,23 @@ def build_k_indices(y, k_fold, seed=1):
                  for k in range(k_fold)]
     return np.array(k_indices)
 
-def cross_validate_kfold(y, x, classifier, k_fold):
+@instrumented
+def cross_validate_kfold(y, x, classifier, k_fold, lambdas=None):
     """
     K-fold cross-validation of a classifier.
 
+    If lambdas are given, the classifier must provide fit_path and predict_path
+    (e.g. LeastSquaresL2) and the whole regularization path is evaluated on
+    every fold.
+
     :param y: y
     :param tx: data
     :param classifier: classifier for model fitting
     :param train: train function (fitting function)
     :param predict: prediction function
     :param k_fold: numbers of folds chosen
-    :return: accuracy
+    :param lambdas: regularization strengths (optional)
+    :return: accuracy per fold, or accuracy matrix (fold x lambda) if lambdas are given
     """
 
     accuracies = []
@@ -212,16 +378,130 @@ def cross_validate_kfold(y, x, classifier, k_fold):
     # Computations for each split in train and test
     for i in range(0, k_fold):
 
-        ind_sort = np.sort(ind[i])
-        ind_opp = np.array(sorted(set(range(0, x.shape[0])).difference(ind_sort)))
+        # training examples are all the examples outside of the fold
+        train = np.ones(x.shape[0], dtype=bool)
+        train[ind[i]] = False
+
+        xtrain, xtest = x[train], x[ind[i]]
+        ytrain, ytest = y[train], y[ind[i]]
 
-        xtrain, xtest = x[ind_opp], x[ind[i]]
-        ytrain, ytest = y[ind_opp], y[ind[i]]
+        if lambdas is None:
+            classifier.fit(ytrain, xtrain)
+            y_pred = classifier.predict(xtest)
 
-        classifier.fit(ytrain, xtrain)
-        y_pred = classifier.predict(xtest)
+            accuracies.append(compute_accuracy(y_pred, ytest))
+        else:
+            classifier.fit_path(ytrain, xtrain, lambdas)
+            y_pred = classifier.predict_path(xtest)
 
-        accuracies.append(compute_accuracy(y_pred, ytest))
+            accuracies.append(np.mean(y_pred == ytest, axis=1))
+
+    if lambdas is not None:
+        return np.array(accuracies)
+
+    return accuracies
+
+
+# largest condition number of the regularized normal equations for which
+# cross_validate_kfold_gram downdates the total normal equations
+DOWNDATE_MAX_CONDITION = 1e8
+
+
+@instrumented
+def cross_validate_kfold_gram(y, x, classifier, k_fold, lambdas=None):
+    """
+    K-fold cross-validation of a least squares classifier from normal equations.
+
+    The normal equations of every fold (and of the examples left out of all
+    folds) are computed once, and the training normal equations of each fold
+    are obtained as total minus fold, so that k-fold costs roughly one pass
+    over the data instead of k fits. Same folds and results as
+    cross_validate_kfold (up to rounding).
+
+    The downdate cancels the digits the fold and the total have in common, which
+    matters when the regularized normal equations are badly conditioned (e.g.
+    condition number around 1e31 with build_X(X, 10, 5) and lambda 1e-12). The
+    condition number is therefore estimated first from the normal equations of
+    the first fold, scaled to all the examples. Above DOWNDATE_MAX_CONDITION
+    the training normal equations of every fold are computed from the training
+    examples, exactly as in cross_validate_kfold, and the first fold only
+    costs one extra pass over a k-th of the data.
+
+    :param y: y
+    :param x: data
+    :param classifier: least squares classifier (LeastSquares, LeastSquaresL2, LeastSquaresL1)
+    :param k_fold: numbers of folds chosen
+    :param lambdas: regularization strengths (optional, LeastSquaresL2 and LeastSquaresL1 only)
+    :return: accuracy per fold, or accuracy matrix (fold x lambda) if lambdas are given
+    """
+
+    # imported here as classifiers depends on this module
+    from classifiers import LeastSquaresL2
+
+    n = x.shape[0]
+    expand, block_size = classifier.expand, classifier.block_size
+
+    # Splitting indices in fold
+    ind = build_k_indices(x, k_fold)
+
+    # smallest ridge added to the normal equations that are solved (the L1 penalty adds none)
+    if not isinstance(classifier, LeastSquaresL2):
+        lambda_min = 0.
+    elif lambdas is not None:
+        lambda_min = min(lambdas)
+    else:
+        lambda_min = classifier.lambda_
+
+    # condition number of the regularized normal equations, estimated on the first fold
+    G_first, b_first = solver.normal_equations(y[ind[0]], x[ind[0]], expand, block_size)
+    G_estimate = G_first * (n / len(ind[0])) + n * lambda_min * np.eye(G_first.shape[0])
+    downdate = np.linalg.cond(G_estimate) <= DOWNDATE_MAX_CONDITION
+
+    if downdate:
+        # normal equations of every fold
+        fold_equations = [ (G_first, b_first) ] + [ solver.normal_equations(y[ind[i]], x[ind[i]], expand, block_size)
+                                                    for i in range(1, k_fold) ]
+        G_total = sum(G for G, _ in fold_equations)
+        b_total = sum(b for _, b in fold_equations)
+
+        # examples that are in no fold are always used for training
+        rest = np.ones(n, dtype=bool)
+        rest[ind.ravel()] = False
+        if np.any(rest):
+            G_rest, b_rest = solver.normal_equations(y[rest], x[rest], expand, block_size)
+            G_total = G_total + G_rest
+            b_total = b_total + b_rest
+
+    accuracies = []
+
+    for i in range(k_fold):
+        n_train = n - len(ind[i])
+
+        if downdate:
+            # downdate the total normal equations with the fold
+            G_fold, b_fold = fold_equations[i]
+            G, b = G_total - G_fold, b_total - b_fold
+        else:
+            # training examples are all the examples outside of the fold
+            train = np.ones(n, dtype=bool)
+            train[ind[i]] = False
+            G, b = solver.normal_equations(y[train], x[train], expand, block_size)
+
+        xtest, ytest = x[ind[i]], y[ind[i]]
+
+        if lambdas is None:
+            classifier.fit_normal_equations(G, b, n_train)
+            y_pred = classifier.predict(xtest)
+
+            accuracies.append(compute_accuracy(y_pred, ytest))
+        else:
+            classifier.fit_path_normal_equations(G, b, n_train, lambdas)
+            y_pred = classifier.predict_path(xtest)
+
+            accuracies.append(np.mean(y_pred == ytest, axis=1))
+
+    if lambdas is not None:
+        return np.array(accuracies)
 
     return accuracies
 
@@ -238,66 +518,117 @@ def compute_accuracy(ypred, yreal):
     return np.mean(ypred == yreal)
 
 
-def split_data(features, X, y=None):
+# features that are undefined for some levels of PRI_jet_num
+UNDEFINED_FEATURES = {
+    'DER_deltaeta_jet_jet'   : [0, 1],
+    'DER_mass_jet_jet'       : [0, 1],
+    'DER_prodeta_jet_jet'    : [0, 1],
+    'DER_lep_eta_centrality' : [0, 1],
+    'PRI_jet_num'            : [0, 1, 2, 3],
+    'PRI_jet_leading_pt'     : [0],
+    'PRI_jet_leading_eta'    : [0],
+    'PRI_jet_leading_phi'    : [0],
+    'PRI_jet_subleading_pt'  : [0, 1],
+    'PRI_jet_subleading_eta' : [0, 1],
+    'PRI_jet_subleading_phi' : [0, 1],
+    'PRI_jet_all_pt'         : [0]
+}
+
+
+@instrumented
+def group_rows(groups, levels):
     """
-    Splits the data matrix X into partitions based on the integer feature 'PRI_jet_num'
-    
+    Rows of every level of an integer-valued feature.
+
+    The rows are sorted once by a stable (radix) argsort of the levels, so
+    the rows of every level stay in their original order, and the level
+    boundaries are given by a bincount. Rows of no level (e.g. values >= levels)
+    are in no group.
+
+    :param groups: value of the grouping feature of every row
+    :param levels: number of levels (values 0, ..., levels - 1)
+    :return: row indices of every level
+    """
+
+    # rows of no level get the code levels and are sorted last
+    valid = (groups >= 0) & (groups < levels) & (groups == np.floor(groups))
+    codes = np.where(valid, groups, levels).astype(np.int16 if levels < 2 ** 15 else np.intp)
+
+    order = np.argsort(codes, kind='stable')
+    bounds = np.r_[0, np.cumsum(np.bincount(codes, minlength=levels + 1))]
+
+    return [ order[bounds[i]:bounds[i+1]] for i in range(levels) ]
+
+
+@functools.lru_cache(maxsize=None)
+def _split_columns(features, group_feature, levels, undefined):
+    """Cached split_columns, with hashable arguments"""
+    undefined = dict(undefined)
+
+    columns = []
+    for level in range(levels):
+        valid = [ j for j, f in enumerate(features) if f != group_feature and level not in undefined.get(f, ()) ]
+        columns.append(np.array(valid, dtype=np.intp))
+        columns[-1].flags.writeable = False
+
+    return tuple(columns)
+
+
+def split_columns(features, group_feature='PRI_jet_num', levels=4, undefined=None):
+    """
+    Indices of the features kept in every split of split_data.
+
+    The grouping feature (constant in every split) and the features undefined
+    for a level are removed. The selections are computed once per set of
+    arguments and cached.
+
+    :param features: feature names
+    :param group_feature: name of the grouping feature
+    :param levels: number of levels of the grouping feature
+    :param undefined: levels for which every feature is undefined (UNDEFINED_FEATURES for PRI_jet_num by default)
+    :return: column indices of every split
+    """
+
+    if undefined is None:
+        undefined = UNDEFINED_FEATURES if group_feature == 'PRI_jet_num' else {}
+
+    undefined = tuple(sorted((f, tuple(undefined_levels)) for f, undefined_levels in undefined.items()))
+
+    return _split_columns(tuple(features), group_feature, levels, undefined)
+
+
+@instrumented
+def split_data(features, X, y=None, group_feature='PRI_jet_num', levels=4, undefined=None):
+    """
+    Splits the data matrix X into partitions based on an integer feature ('PRI_jet_num' by default)
+
+    The rows of every level are found with a single sort (see group_rows) and
+    every split is gathered with its kept columns (see split_columns) into a
+    contiguous array.
+
     :param features: feature names
     :param X: examples
     :param y: labels (optional)
-    :return indices of split for every subset, X_split, y_split
-    """
-    # features that are undefined for some subsets
-    undef_feature_for = {
-        'DER_deltaeta_jet_jet'   : [0, 1],
-        'DER_mass_jet_jet'       : [0, 1],
-        'DER_prodeta_jet_jet'    : [0, 1],
-        'DER_lep_eta_centrality' : [0, 1],
-        'PRI_jet_num'            : [0, 1, 2, 3],
-        'PRI_jet_leading_pt'     : [0],
-        'PRI_jet_leading_eta'    : [0],
-        'PRI_jet_leading_phi'    : [0],
-        'PRI_jet_subleading_pt'  : [0, 1],
-        'PRI_jet_subleading_eta' : [0, 1],
-        'PRI_jet_subleading_phi' : [0, 1],
-        'PRI_jet_all_pt'         : [0]
-    }
-
-    # the feature based on which we split X
-    jet_num_feature = "PRI_jet_num"
-    jet_levels = 4
-
-    # build valid features for every subset of X
-    features_split = []
-    for jet in range(jet_levels):
-        valid_features = [ f for f in features if not ((f in undef_feature_for) and (jet in undef_feature_for[f])) ]
-        features_split.append(valid_features)
-        
-    # split data based on jet level (vertical split)
-    X_ = X.copy()
-    
-    split_indices = [
-        X_[:,features.index(jet_num_feature)] == i for i in range(jet_levels)
-    ]
-    X_split = [
-        X_[X_[:,features.index(jet_num_feature)] == i,:] for i in range(jet_levels)
-    ]
+    :param group_feature: name of the grouping feature
+    :param levels: number of levels of the grouping feature
+    :param undefined: levels for which every feature is undefined (UNDEFINED_FEATURES for PRI_jet_num by default)
+    :return indices of split for every subset (integer arrays), X_split, y_split
+    """
+
+    split_indices = group_rows(X[:, features.index(group_feature)], levels)
+    columns = split_columns(features, group_feature, levels, undefined)
+
+    X_split = [ X.take(rows, axis=0).take(cols, axis=1) for rows, cols in zip(split_indices, columns) ]
+
     if y is None:
         y_split = None
     else:
-        y_split = [
-            y[X_[:,features.index(jet_num_feature)] == i] for i in range(jet_levels)
-        ]
-
-    # only keep relevant features (horizontal split)
-    for i, x in enumerate(X_split):
-        indices = [ features.index(feature) for feature in features_split[i] ]
-        indices_bool = [ e in indices for e in range(len(features)) ]
-        X_split[i] = x[:,indices_bool]
-        
+        y_split = [ y[rows] for rows in split_indices ]
+
     return split_indices, X_split, y_split
 
 
+@instrumented
 def build_poly_no_interaction(X, degree):
     """
     Build a polynomial expansion of X without interaction terms.
@@ -305,50 +636,282 @@ def build_poly_no_interaction(X, degree):
     :param X: data
     :param degree: degree of expansion
     """
-    result = X.copy()
-    for d in range(2, degree+1):
-        # np.power() behaves strangely sometimes, so we do the multiplication manually
-        power = X.copy()
-        for i in range(d - 1):
-            power = power * X
-            
-        result = np.hstack((result, power))
+    n, d = X.shape
+    result = np.empty((n, d * degree), dtype=X.dtype)
+
+    # every power is the previous one multiplied by X
+    result[:, :d] = X
+    for i in range(1, degree):
+        np.multiply(result[:, (i-1)*d:i*d], X, out=result[:, i*d:(i+1)*d])
         
     return result
 
-def build_X(X, d_int, d_sq):
+
+def build_X_width(d, d_int, d_sq):
+    """
+    Number of columns of build_X.
+
+    :param d: number of columns of X
+    :param d_int: degree of integer powers
+    :param d_sq: ceil of degree of half-powers
+    :return: number of columns of the expansion
+    """
+    # half-powers are 0.5 alone, or 0.5 (twice) and 1.5, ..., d_sq - 0.5
+    n_sq = 0 if d_sq <= 0 else 1 if d_sq == 1 else d_sq + 1
+
+    return d * (max(d_int, 0) + n_sq)
+
+
+@instrumented
+def build_X(X, d_int, d_sq, out=None, dtype=None):
     """
     Expand X with integer and/or half-powers.
+
+    The columns are [X, X^2, ..., X^d_int, |X|^0.5] followed, if d_sq > 1, by
+    [|X|^0.5, |X|^1.5, ..., |X|^(d_sq - 0.5)]. The expansion is written in a
+    single preallocated array, every power being obtained from the previous one.
     
     :param X: examples
     :param d_int: degree of integer powers
     :param d_sq: ceil of degree of half-powers (expansion will be up to d_sq - 0.5)
+    :param out: array of shape (n, build_X_width(d, d_int, d_sq)) to write the expansion to
+    :param dtype: type of the expansion (dtype of X by default)
     """    
-    X_ = X.copy()
-    
-    ints = []
-    sqrts = []
-    
+    n, d = X.shape
+    width = build_X_width(d, d_int, d_sq)
+
+    if out is None:
+        out = np.empty((n, width), dtype=X.dtype if dtype is None else dtype)
+    elif out.shape != (n, width):
+        raise ValueError(f"out must have shape {(n, width)}, got {out.shape}")
+
+    # views of the successive blocks of d columns
+    blocks = ( out[:, i:i+d] for i in range(0, width, d) )
+
     # build integer powers
-    if d_int > 0:
-        ints = build_poly_no_interaction(X_, d_int)
-      
+    ints = []
+    for i in range(max(d_int, 0)):
+        block = next(blocks)
+        if i == 0:
+            block[...] = X
+        else:
+            np.multiply(ints[-1], X, out=block)
+        ints.append(block)
+
     # build half-powers (0.5, 1.5, 2.5, etc.)
     if d_sq > 0:
-        sqrts = np.sqrt(np.abs(X_))
-        if d_sq > 1:
-            width = sqrts.shape[1]
-            int_power = np.abs(build_poly_no_interaction(X_, d_sq - 1))
-            
-            half_power = sqrts.copy()
-            for i in range(d_sq - 1):
-                # add half power i - 0.5
-                half_power = np.hstack((half_power, sqrts * int_power[:,(width*i):(width*(i+1))]))
-                
-            sqrts = np.hstack((sqrts, half_power))
-    else:
-        return ints
+        sqrts = next(blocks)
+        np.abs(X, out=sqrts)
+        np.sqrt(sqrts, out=sqrts)
+
+    if d_sq > 1:
+        next(blocks)[...] = sqrts
+
+        power = None
+        for i in range(1, d_sq):
+            # |X^i|, from the integer powers when available
+            block = next(blocks)
+            if i <= len(ints):
+                np.abs(ints[i-1], out=block)
+            else:
+                if power is None:
+                    power = X.copy() if not ints else ints[-1] * X
+                else:
+                    power *= X
+                np.abs(power, out=block)
+
+            # half power i + 0.5
+            block *= sqrts
+
+    return out
+
+
+class Pipeline:
+    """Preprocessing pipeline: split_data, remove_NaN_features, standardize and build_X"""
+
+    def __init__(self, features, nan_threshold=0.2, d_int=10, d_sq=5, dtype=None):
+        """
+        Constructor
+
+        :param features: feature names of the data
+        :param nan_threshold: maximum fraction of -999 values of a kept feature
+        :param d_int: degree of integer powers of build_X
+        :param d_sq: ceil of degree of half-powers of build_X
+        :param dtype: type of the standardized and expanded data (float64 by default, e.g. np.float32)
+        """
+
+        self.features = list(features)
+        self.nan_threshold = nan_threshold
+        self.d_int = d_int
+        self.d_sq = d_sq
+        self.dtype = None if dtype is None else np.dtype(dtype)
+
+    @instrumented
+    def fit(self, X):
+        """
+        Learns the kept columns, means and standard deviations of every split
+
+        :param X: training data
+        :return: self
+        """
+
+        self.fit_transform(X)
+        return self
+
+    @instrumented
+    def fit_transform(self, X, y=None, expand=True):
+        """
+        Learns the preprocessing state from training data and transforms it
+
+        :param X: training data
+        :param y: labels (optional)
+        :param expand: expand the splits with build_X
+        :return: indices of split for every subset, X_split, y_split
+        """
+
+        split_indices, X_split, y_split = split_data(self.features, X, y)
+
+        self.columns, self.mean, self.std = [], [], []
+        for i, X_ in enumerate(X_split):
+            # remove features with too many NaN and standardize
+            X_nan, columns = remove_NaN_features(X_, self.nan_threshold, return_columns=True)
+            X_split[i], mean, std = standardize(X_nan, dtype=self.dtype)
+
+            self.columns.append(columns)
+            self.mean.append(mean)
+            self.std.append(std)
+
+        if expand:
+            X_split = [ self.expand(X_) for X_ in X_split ]
+
+        return split_indices, X_split, y_split
+
+    @instrumented
+    def fit_chunks(self, chunks):
+        """
+        Learns the preprocessing state from training data read chunk by chunk
+
+        A single pass counts the -999 values and accumulates the running mean and
+        variance of every column of every split, so that memory does not depend
+        on the number of rows. The state is the one of fit_transform up to rounding.
+
+        :param chunks: iterable of chunks of training data
+        :return: self
+        """
+
+        statistics, nan_counts = None, None
+        for X in chunks:
+            _, X_split, _ = split_data(self.features, X)
+
+            if statistics is None:
+                statistics = [ RunningStatistics(X_.shape[1]) for X_ in X_split ]
+                nan_counts = [ np.zeros(X_.shape[1], dtype=np.int64) for X_ in X_split ]
+
+            for X_, split_statistics, split_nan_counts in zip(X_split, statistics, nan_counts):
+                split_statistics.update(X_)
+                split_nan_counts += np.count_nonzero(X_ == -999, axis=0)
+
+        self.columns, self.mean, self.std = [], [], []
+        for split_statistics, split_nan_counts in zip(statistics, nan_counts):
+            # same rule as remove_NaN_features
+            columns = np.flatnonzero(split_nan_counts / split_statistics.count < self.nan_threshold)
+
+            self.columns.append(columns)
+            self.mean.append(split_statistics.mean[columns])
+            self.std.append(split_statistics.scale()[columns])
+
+        return self
+
+    @instrumented
+    def transform(self, X, y=None, expand=True):
+        """
+        Transforms new data with the learned preprocessing state
+
+        :param X: data
+        :param y: labels (optional)
+        :param expand: expand the splits with build_X
+        :return: indices of split for every subset, X_split, y_split
+        """
+
+        split_indices, X_split, y_split = split_data(self.features, X, y)
+
+        for i, X_ in enumerate(X_split):
+            # keep the training features and standardize with the training statistics
+            X_split[i], _, _ = standardize(remove_NaN_features(X_, columns=self.columns[i]),
+                                           self.mean[i], self.std[i], self.dtype)
+            if expand:
+                X_split[i] = self.expand(X_split[i])
+
+        return split_indices, X_split, y_split
+
+    def expand(self, X):
+        """
+        Polynomial expansion of standardized data (can be given to the classifiers)
+
+        :param X: standardized data of a split
+        :return: expanded data
+        """
+
+        return build_X(X, self.d_int, self.d_sq, dtype=self.dtype)
+
+    def state(self):
+        """
+        Learned state as a dictionary of arrays
+
+        :return: state
+        """
+
+        state = {
+            'features': np.array(self.features),
+            'nan_threshold': np.array(self.nan_threshold),
+            'degrees': np.array([self.d_int, self.d_sq]),
+            'dtype': np.array('' if self.dtype is None else self.dtype.str),
+        }
+        for i, (columns, mean, std) in enumerate(zip(self.columns, self.mean, self.std)):
+            state[f'columns_{i}'] = columns
+            state[f'mean_{i}'] = mean
+            state[f'std_{i}'] = std
+
+        return state
+
+    @classmethod
+    def from_state(cls, state):
+        """
+        Rebuilds a fitted pipeline from its state
+
+        :param state: state returned by state()
+        :return: pipeline
+        """
+
+        d_int, d_sq = state['degrees']
+        dtype = str(state['dtype']) if 'dtype' in state else ''
+        pipeline = cls(state['features'].tolist(), float(state['nan_threshold']), int(d_int), int(d_sq),
+                       dtype or None)
+
+        n_splits = sum(1 for key in state if key.startswith('columns_'))
+        pipeline.columns = [ np.asarray(state[f'columns_{i}']) for i in range(n_splits) ]
+        pipeline.mean = [ np.asarray(state[f'mean_{i}']) for i in range(n_splits) ]
+        pipeline.std = [ np.asarray(state[f'std_{i}']) for i in range(n_splits) ]
+
+        return pipeline
+
+    def save(self, path):
+        """
+        Saves the fitted pipeline to a .npz file
+
+        :param path: file path
+        """
+
+        np.savez(path, **self.state())
+
+    @classmethod
+    def load(cls, path):
+        """
+        Loads a pipeline saved with save()
+
+        :param path: file path
+        :return: pipeline
+        """
 
-    # concat
-    X_ = np.hstack((ints, sqrts))
-    return X_
+        with np.load(path) as state:
+            return cls.from_state(dict(state))
@@ -1,13 +1,15 @@
 # -*- coding: utf-8 -*-
 """Implementations"""
+import time
 import numpy as np
+import solver
 
 
 ###########################
 # Least squares 
 ###########################
 
-def least_squares_GD(y, tx, initial_w, max_iters, gamma):
+def least_squares_GD(y, tx, initial_w, max_iters, gamma, validation=None, **gd_options):
     """
     Linear Regression using gradient descent.
 
@@ -16,36 +18,45 @@ def least_squares_GD(y, tx, initial_w, max_iters, gamma):
     :param initial_w: initial weights
     :param max_iters: maximum number of iterations
     :param gamma: gamma
-    :return: weights, loss
+    :param validation: validation data (y, tx) for early stopping
+    :param gd_options: grad_tol, loss_tol, patience, history (see GD)
+    :return: weights, loss (, history)
     """
     
     def loss_function(w):
         # compute the loss and gradient using all examples
         return least_squares_loss_function(y, tx, w)
 
-    return GD(loss_function, initial_w, max_iters, gamma)
+    if validation is not None:
+        gd_options['validation_loss'] = lambda w: least_squares_loss_function(*validation, w)[0]
+
+    return GD(loss_function, initial_w, max_iters, gamma, **gd_options)
     
     
-def least_squares_SGD(y, tx, initial_w, max_iters, gamma):
+def least_squares_SGD(y, tx, initial_w, max_iters, gamma, batch_size=1, schedule='constant',
+                      momentum=0., seed=None, verbose=False):
     """
-    Linear Regression using stochastic gradient descent.
+    Linear Regression using (mini-batch) stochastic gradient descent.
 
     :param y: target
     :param tx: data
     :param initial_w: initial weights
-    :param max_iters: maximum number of iterations
+    :param max_iters: maximum number of iterations (batches)
     :param gamma: gamma
+    :param batch_size: number of examples per batch
+    :param schedule: step size schedule (see SGD)
+    :param momentum: momentum coefficient
+    :param seed: seed of the permutations (None to use the global random state)
+    :param verbose: print progress and throughput
     :return: weights, loss
     """
 
-    def loss_function(w):
-        # select a single example to compute the loss and the gradient
-        index = np.random.randint(0, len(y))
-        ySGD = y[index]
-        xSGD = np.array([tx[index,:]])
-        return least_squares_loss_function(ySGD, xSGD, w)
+    def batch_loss_function(w, batch):
+        # mean loss and gradient of the batch estimate those of all examples
+        return least_squares_loss_function(y[batch], tx[batch], w)
 
-    return GD(loss_function, initial_w, max_iters, gamma)
+    return SGD(batch_loss_function, len(y), initial_w, max_iters, gamma, batch_size,
+               schedule=schedule, momentum=momentum, seed=seed, verbose=verbose)
 
     
 def least_squares_loss_function(y, tx, w):
@@ -86,26 +97,41 @@ def least_squares(y, tx):
     return w, 1/(2*n) * np.sum((y - tx @ w) ** 2)
 
 
-def ridge_regression(y, tx, lambda_):
+def ridge_regression(y, tx, lambda_, expand=None, block_size=None):
     """
     Ridge Regression using normal equations.
     (Least Squares with L2 regularization)
 
+    With a block size, the normal equations are accumulated block by block
+    (see solver.normal_equations) and the loss is computed from them, so that
+    the expanded data is never built in full.
+
     :param y: target
     :param tx: data
     :param lambda_: hyperparamter
+    :param expand: feature expansion applied to tx (e.g. build_X)
+    :param block_size: number of rows expanded at once (None to use all rows at once)
     :return: weight, loss
     """
     
-    n, d = tx.shape
-    w = np.zeros(d)
+    n = tx.shape[0]
 
-    # solve normal equations
-    w = np.linalg.solve(tx.T @ tx + n*lambda_ * np.eye(d), tx.T @ y)
+    if expand is None and block_size is None:
+        d = tx.shape[1]
 
-    # return loss and gradient
-    # return weight and loss
-    return w, 1/(2*n) * np.sum((y - tx @ w) ** 2) + lambda_/2 * w.T.dot(w)
+        # solve normal equations
+        w = np.linalg.solve(tx.T @ tx + n*lambda_ * np.eye(d), tx.T @ y)
+
+        # return weight and loss
+        return w, 1/(2*n) * np.sum((y - tx @ w) ** 2) + lambda_/2 * w.T.dot(w)
+
+    # solve accumulated normal equations
+    G, b = solver.normal_equations(y, tx, expand, block_size)
+    d = G.shape[0]
+    w = np.linalg.solve(G + n*lambda_ * np.eye(d), b)
+
+    # ||y - Xw||^2 = y'y - 2 w'X'y + w'X'Xw
+    return w, 1/(2*n) * (y.dot(y) - 2 * w.dot(b) + w.dot(G @ w)) + lambda_/2 * w.T.dot(w)
 
 
 ###########################
@@ -113,7 +139,7 @@ def ridge_regression(y, tx, lambda_):
 ###########################
 
 
-def logistic_regression(y, tx, initial_w, max_iters, gamma):
+def logistic_regression(y, tx, initial_w, max_iters, gamma, batch_size=None, validation=None, **options):
     """
     Logistic Regression using gradient descent or SGD
 
@@ -122,16 +148,36 @@ def logistic_regression(y, tx, initial_w, max_iters, gamma):
     :param initial_w: initial weights
     :param max_iters: maximum number of iterations
     :param gamma: gamma parameter
-    :return: weights, loss
+    :param batch_size: number of examples per batch of SGD (None for gradient descent)
+    :param validation: validation data (y, tx) for early stopping of gradient descent
+    :param options: options of SGD (schedule, decay, momentum, seed, verbose)
+                    or GD (grad_tol, loss_tol, patience, history)
+    :return: weights, loss (, history)
     """
     
+    if batch_size is not None:
+        def batch_loss_function(w, batch):
+            # scale the batch to estimate the loss and gradient of all examples
+            f, g = log_reg_loss_function(y[batch], tx[batch], w)
+            scale = len(y) / len(y[batch])
+            return scale * f, scale * g
+
+        return SGD(batch_loss_function, len(y), initial_w, max_iters, gamma, batch_size, **options)
+
+    # work arrays shared by all the iterations
+    buffers = {}
+
     def loss_function(w):
-        return log_reg_loss_function(y, tx, w)
+        return log_reg_loss_function(y, tx, w, buffers)
+
+    if validation is not None:
+        options['validation_loss'] = lambda w: log_reg_loss_function(*validation, w)[0]
 
-    return GD(loss_function, initial_w, max_iters, gamma)
+    return GD(loss_function, initial_w, max_iters, gamma, **options)
 
     
-def reg_logistic_regression(y, tx, lambda_, initial_w, max_iters, gamma):
+def reg_logistic_regression(y, tx, lambda_, initial_w, max_iters, gamma, batch_size=None, validation=None,
+                            **options):
     """
     L2 Regularized Logistic Regression using gradient descent or SGD
 
@@ -140,11 +186,29 @@ def reg_logistic_regression(y, tx, lambda_, initial_w, max_iters, gamma):
     :param initial_w: initial weights
     :param max_iters: maximum number of iterations
     :param gamma: gamma parameter
-    :return: weights, loss
+    :param batch_size: number of examples per batch of SGD (None for gradient descent)
+    :param validation: validation data (y, tx) for early stopping of gradient descent
+    :param options: options of SGD (schedule, decay, momentum, seed, verbose)
+                    or GD (grad_tol, loss_tol, patience, history)
+    :return: weights, loss (, history)
     """
 
+    if batch_size is not None:
+        def batch_loss_function(w, batch):
+            # scale the batch to estimate the loss and gradient of all examples
+            f, g = log_reg_loss_function(y[batch], tx[batch], w)
+            scale = len(y) / len(y[batch])
+
+            # add regularization terms
+            return scale * f + lambda_ / 2. * w.dot(w), scale * g + lambda_ * w
+
+        return SGD(batch_loss_function, len(y), initial_w, max_iters, gamma, batch_size, **options)
+
+    # work arrays shared by all the iterations
+    buffers = {}
+
     def loss_function(w):
-        f, g = log_reg_loss_function(y, tx, w)
+        f, g = log_reg_loss_function(y, tx, w, buffers)
 
         # add regularization terms
         f += lambda_ / 2. * w.dot(w)
@@ -152,25 +216,63 @@ def reg_logistic_regression(y, tx, lambda_, initial_w, max_iters, gamma):
 
         return f, g
 
-    return GD(loss_function, initial_w, max_iters, gamma)
+    if validation is not None:
+        options['validation_loss'] = lambda w: log_reg_loss_function(*validation, w)[0]
+
+    return GD(loss_function, initial_w, max_iters, gamma, **options)
     
     
-def log_reg_loss_function(y, tx, w):
+def log_reg_loss_function(y, tx, w, buffers=None):
     """Logistic regression loss function
 
+    Computes the loss and the gradient from a single margin vector m = y * tx @ w
+    and a single exponential e = exp(-|m|) <= 1, without overflow:
+    log(1 + exp(-m)) = log(1 + e) - min(m, 0) and
+    1 / (1 + exp(m)) = e / (1 + e) if m >= 0, 1 - e / (1 + e) otherwise.
+
+    The n-length work arrays are taken from (and stored in) buffers, so a
+    solver calling the function repeatedly with the same dictionary does not
+    allocate them at every evaluation.
+
     :param y: y
     :param tx: data
     :param w: weights
+    :param buffers: dictionary of work arrays reused across calls (optional)
     :return: loss, gradient
     """
-    
-    yXw = y * (tx @ w)
-
-    # compute the function value
-    f = np.sum(np.log(1. + np.exp(-yXw)))
 
-    # compute the gradient value
-    g = tx.T @ (- y / (1. + np.exp(yXw)))
+    if buffers is None:
+        buffers = {}
+
+    # the products are computed in the type of the data (e.g. float32), the sums in float64
+    dtype = tx.dtype
+    if 'margin' not in buffers or buffers['margin'].shape != y.shape or buffers['margin'].dtype != dtype:
+        buffers['margin'] = np.empty(y.shape, dtype=dtype)
+        buffers['exp'] = np.empty(y.shape, dtype=dtype)
+        buffers['work'] = np.empty(y.shape, dtype=dtype)
+    margin, e, work = buffers['margin'], buffers['exp'], buffers['work']
+
+    # margin m = y * tx @ w
+    np.matmul(tx, w.astype(dtype, copy=False), out=margin)
+    margin *= y
+
+    # e = exp(-|m|)
+    np.abs(margin, out=e)
+    np.negative(e, out=e)
+    np.exp(e, out=e)
+
+    # compute the function value, log(1 + exp(-m)) = log(1 + e) - min(m, 0)
+    np.log1p(e, out=work)
+    f = np.sum(work, dtype=np.float64)
+    np.minimum(margin, 0., out=work)
+    f -= np.sum(work, dtype=np.float64)
+
+    # compute the gradient value, - y / (1 + exp(m))
+    np.add(e, 1., out=work)
+    np.divide(e, work, out=e)
+    np.subtract(1., e, out=e, where=margin < 0)
+    e *= y
+    g = -(tx.T @ e).astype(np.float64, copy=False)
 
     return f, g
     
@@ -179,16 +281,33 @@ def log_reg_loss_function(y, tx, w):
 # Solvers and helpers
 ###########################
 
-def GD(loss_function, w, max_iters, gamma):
+def GD(loss_function, w, max_iters, gamma, grad_tol=None, loss_tol=None, validation_loss=None,
+       patience=None, history=False):
     """
     Gradient descent
+
+    Without the optional stopping criteria, exactly max_iters iterations are run.
+    With a validation loss and a patience, the weights with the best validation
+    loss are returned once it has not improved for patience iterations.
+
     :param loss_function: function to calculate loss
     :param w: initial weight vector
     :param max_iters: maximum number of iterations
     :param gamma: gradient descent parameter
-    :return: weight, loss
+    :param grad_tol: stop when the norm of the gradient is below grad_tol
+    :param loss_tol: stop when the relative decrease of the loss is below loss_tol
+    :param validation_loss: function of w returning the loss on validation data
+    :param patience: number of iterations without improvement of the validation loss before stopping
+    :param history: also return the history of the loss (and validation loss) and time per iteration
+    :return: weight, loss (, history)
     """
 
+    start = time.perf_counter()
+    trace = {'loss': [], 'time': []}
+    if validation_loss is not None:
+        trace['validation_loss'] = []
+        best_w, best_validation, waited = w, validation_loss(w), 0
+
     # inital evaluation
     f, g = loss_function(w)
     evals = 0
@@ -201,15 +320,115 @@ def GD(loss_function, w, max_iters, gamma):
         f_new, g_new = loss_function(w_new)
         evals += 1
 
+        # relative decrease of the loss
+        decrease = (f - f_new) / max(abs(f), np.finfo(float).tiny)
+
         # update weights / loss / gradient
         w = w_new
         f = f_new
         g = g_new
 
+        if history:
+            trace['loss'].append(f)
+            trace['time'].append(time.perf_counter() - start)
+
         # test stopping conditions
         if evals >= max_iters:
             break
 
+        if grad_tol is not None and np.linalg.norm(g) < grad_tol:
+            break
+
+        if loss_tol is not None and abs(decrease) < loss_tol:
+            break
+
+        if validation_loss is not None:
+            f_validation = validation_loss(w)
+            if history:
+                trace['validation_loss'].append(f_validation)
+
+            if f_validation < best_validation:
+                best_w, best_validation, waited = w, f_validation, 0
+            else:
+                waited += 1
+                if patience is not None and waited >= patience:
+                    # restore the best weights
+                    w, (f, g) = best_w, loss_function(best_w)
+                    break
+
+    if history:
+        return w, f, trace
+
+    return w, f
+
+
+def SGD(batch_loss_function, n, w, max_iters, gamma, batch_size=1, schedule='constant', decay=1.,
+        momentum=0., seed=None, verbose=False):
+    """
+    Mini-batch stochastic gradient descent
+
+    Every epoch goes through a new random permutation of the examples, batch
+    by batch. The step size follows a schedule over the epochs:
+    'constant' gamma, 'inverse' gamma / (1 + decay * epoch) or
+    'sqrt' gamma / sqrt(1 + decay * epoch). With momentum, the steps are
+    accumulated in a velocity (heavy ball).
+
+    :param batch_loss_function: function of (w, batch) returning estimates of the loss and gradient
+                                of all examples from the examples of the batch
+    :param n: number of examples
+    :param w: initial weight vector
+    :param max_iters: maximum number of iterations (batches)
+    :param gamma: step size
+    :param batch_size: number of examples per batch
+    :param schedule: step size schedule ('constant', 'inverse', 'sqrt')
+    :param decay: decay rate of the schedule
+    :param momentum: momentum coefficient (0 for plain SGD)
+    :param seed: seed of the permutations (None to use the global random state)
+    :param verbose: print progress and throughput
+    :return: weight, loss of all examples
+    """
+
+    schedules = {
+        'constant': lambda epoch: gamma,
+        'inverse': lambda epoch: gamma / (1. + decay * epoch),
+        'sqrt': lambda epoch: gamma / np.sqrt(1. + decay * epoch),
+    }
+    step_size = schedules[schedule]
+
+    random = np.random if seed is None else np.random.RandomState(seed)
+    velocity = np.zeros_like(w, dtype=float)
+
+    start = time.perf_counter()
+    iters, rows, epoch = 0, 0, 0
+
+    while iters < max_iters:
+        permutation = random.permutation(n)
+        gamma_epoch = step_size(epoch)
+
+        for begin in range(0, n, batch_size):
+            # sorted indices read the examples in memory order
+            batch = np.sort(permutation[begin:begin + batch_size])
+            f, g = batch_loss_function(w, batch)
+
+            velocity = momentum * velocity - gamma_epoch * g
+            w = w + velocity
+
+            iters += 1
+            rows += len(batch)
+            if iters >= max_iters:
+                break
+
+        epoch += 1
+        if verbose:
+            print("epoch %d - batch loss: %.3f - %.0f rows/s" % (epoch, f, rows / (time.perf_counter() - start)))
+
+    # loss of all examples
+    f, _ = batch_loss_function(w, slice(None))
+
+    if verbose:
+        print("%d iterations, %d rows in %.2fs (%.0f rows/s) - loss: %.3f"
+              % (iters, rows, time.perf_counter() - start, rows / (time.perf_counter() - start), f))
+
     return w, f
 
 
@@ -220,7 +439,4 @@ def log_1_plus_exp_safe(x):
     :param x: input
     :return: log(1+exp(x))
     """
-    out = np.log(1+np.exp(x))
-    out[x > 100] = x[x>100]
-    out[x < -100] = np.exp(x[x < -100])
-    return out
+    return np.logaddexp(0., x)
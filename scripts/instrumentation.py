@@ -0,0 +1,297 @@
+# -*- coding: utf-8 -*-
+"""Per-stage timing and profiling instrumentation"""
+
+import atexit
+import cProfile
+import functools
+import json
+import os
+import sys
+import threading
+import time
+import numpy as np
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows, peak RSS is then reported as None
+    resource = None
+
+
+# instrumentation is off unless enabled by the INSTRUMENT environment variable or by enable()
+_enabled = False
+
+# records of the stages and instrumented functions, keyed by their path
+# (names of the enclosing stages and their own), in order of first call
+_records = {}
+_lock = threading.Lock()
+
+# path of the current stage of every thread
+_local = threading.local()
+
+# output files and profiler of the current run
+_settings = {'output': None, 'profile': None, 'profiler': None, 'registered': False}
+
+
+def enable(output=None, profile=None):
+    """
+    Switches the instrumentation on.
+
+    The report is printed to stderr when the process exits (and saved as
+    JSON to output). If profile is given, the thread calling enable is
+    also profiled with cProfile and the statistics are dumped to that file
+    (readable with pstats or snakeviz).
+
+    :param output: json file of the report (None to only print it)
+    :param profile: file of the cProfile statistics (None to not profile)
+    """
+
+    global _enabled
+    _enabled = True
+
+    _settings['output'], _settings['profile'] = output, profile
+    if profile is not None and _settings['profiler'] is None:
+        _settings['profiler'] = cProfile.Profile()
+        _settings['profiler'].enable()
+
+    if not _settings['registered']:
+        atexit.register(finish)
+        _settings['registered'] = True
+
+
+def disable():
+    """Switches the instrumentation off (recorded stages are kept)"""
+    global _enabled
+    _enabled = False
+
+
+def is_enabled():
+    """Whether the instrumentation is on"""
+    return _enabled
+
+
+def reset():
+    """Forgets the recorded stages"""
+    with _lock:
+        _records.clear()
+
+
+def peak_rss():
+    """Peak resident memory of the process so far, in bytes (None if it cannot be measured)"""
+    if resource is None:
+        return None
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def array_bytes(*values):
+    """Total size of the arrays among values (and nested in the tuples, lists and dictionaries among them), in bytes"""
+    total = 0
+    for value in values:
+        if isinstance(value, np.ndarray):
+            total += value.nbytes
+        elif isinstance(value, (tuple, list)):
+            total += array_bytes(*value)
+        elif isinstance(value, dict):
+            total += array_bytes(*value.values())
+    return total
+
+
+class Stage:
+    """Measurement of one execution of a stage, see stage and instrumented"""
+
+    def __init__(self, name, inputs=0, cpu_clock=time.process_time):
+        """
+        Constructor
+
+        :param name: name of the stage
+        :param inputs: size of the input arrays, in bytes
+        :param cpu_clock: clock of the CPU time (process or thread)
+        """
+
+        self.name = name
+        self.inputs = inputs
+        self.outputs = 0
+        self.cpu_clock = cpu_clock
+
+    def output(self, *values):
+        """
+        Records the arrays produced by the stage.
+
+        :param values: arrays (or tuples and lists of arrays)
+        """
+
+        self.outputs += array_bytes(*values)
+
+    def __enter__(self):
+        # a stage called from different stages has one record per caller
+        self.parent = getattr(_local, 'path', ())
+        self.path = self.parent + (self.name,)
+        _local.path = self.path
+
+        with _lock:
+            if self.path not in _records:
+                _records[self.path] = {'name': self.name, 'path': self.path, 'depth': len(self.parent), 'calls': 0,
+                                       'wall_time': 0., 'cpu_time': 0., 'peak_rss': None, 'input_bytes': 0,
+                                       'output_bytes': 0}
+
+        self.start, self.start_cpu = time.perf_counter(), self.cpu_clock()
+        return self
+
+    def __exit__(self, *exc_info):
+        wall_time, cpu_time = time.perf_counter() - self.start, self.cpu_clock() - self.start_cpu
+        _local.path = self.parent
+        rss = peak_rss()
+
+        with _lock:
+            record = _records[self.path]
+            record['calls'] += 1
+            record['wall_time'] += wall_time
+            record['cpu_time'] += cpu_time
+            if rss is not None:
+                record['peak_rss'] = max(record['peak_rss'] or 0, rss)
+            record['input_bytes'] = max(record['input_bytes'], self.inputs)
+            record['output_bytes'] = max(record['output_bytes'], self.outputs)
+
+        return False
+
+
+class _NullStage:
+    """Stage doing nothing, returned by stage when the instrumentation is off"""
+
+    def output(self, *values):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_null_stage = _NullStage()
+
+
+def stage(name, *inputs):
+    """
+    Context manager measuring a block of code.
+
+    with stage("load train data") as s:
+        y, tX, ids, features = load_csv_data(path)
+        s.output(tX)
+
+    The CPU time is the one of the whole process (including the threads
+    started by the block). When the instrumentation is off, a shared object
+    doing nothing is returned.
+
+    :param name: name of the stage
+    :param inputs: input arrays (or tuples and lists of arrays) whose size is recorded
+    :return: context manager
+    """
+
+    if not _enabled:
+        return _null_stage
+
+    return Stage(name, array_bytes(*inputs))
+
+
+def instrumented(function):
+    """
+    Decorator recording every call of a function as a stage named after it.
+
+    The sizes of the array arguments and results are recorded and the CPU
+    time is the one of the calling thread, as functions can run concurrently
+    (see parallel.map_splits). When the instrumentation is off the wrapper
+    only adds a test of a global variable to the call.
+
+    :param function: function (or method) to instrument
+    :return: instrumented function
+    """
+
+    name = function.__qualname__
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        if not _enabled:
+            return function(*args, **kwargs)
+
+        with Stage(name, array_bytes(*args, *kwargs.values()), time.thread_time) as measurement:
+            result = function(*args, **kwargs)
+            measurement.output(result)
+
+        return result
+
+    return wrapper
+
+
+def report():
+    """
+    Structured report of the recorded stages.
+
+    Every record aggregates the calls of a stage from the same enclosing stage,
+    and follows the record of that stage (depth first, in order of first call).
+    Functions called in other threads (e.g. by parallel.map_splits) start at
+    the top level.
+
+    :return: list of records (name, path, depth, calls, wall_time, cpu_time, peak_rss, input_bytes, output_bytes)
+    """
+
+    with _lock:
+        records = [ dict(record, path=list(record['path'])) for record in _records.values() ]
+
+    children = {}
+    for record in records:
+        children.setdefault(tuple(record['path'][:-1]), []).append(record)
+
+    ordered = []
+
+    def visit(path):
+        for record in children.get(path, []):
+            ordered.append(record)
+            visit(tuple(record['path']))
+
+    visit(())
+
+    return ordered
+
+
+def print_report(file=sys.stderr):
+    """
+    Prints the report as a table.
+
+    :param file: output stream
+    """
+
+    print(f"{'stage':48} {'calls':>6} {'wall (s)':>9} {'cpu (s)':>9} {'peak RSS (MB)':>14} "
+          f"{'in (MB)':>9} {'out (MB)':>9}", file=file)
+    for record in report():
+        name = "  " * record['depth'] + record['name']
+        rss = "n/a" if record['peak_rss'] is None else f"{record['peak_rss'] / 2 ** 20:.1f}"
+        print(f"{name:48} {record['calls']:6d} {record['wall_time']:9.3f} {record['cpu_time']:9.3f} "
+              f"{rss:>14} {record['input_bytes'] / 2 ** 20:9.1f} "
+              f"{record['output_bytes'] / 2 ** 20:9.1f}", file=file)
+
+
+def finish():
+    """Stops the profiler and writes the report and the profile (called at exit once enabled)"""
+    profiler = _settings['profiler']
+    if profiler is not None:
+        profiler.disable()
+        profiler.dump_stats(_settings['profile'])
+        _settings['profiler'] = None
+
+    if not _records:
+        return
+
+    print_report()
+
+    if _settings['output'] is not None:
+        with open(_settings['output'], 'w') as f:
+            json.dump({'peak_rss': peak_rss(), 'stages': report()}, f, indent=2)
+
+
+if os.environ.get('INSTRUMENT', '') not in ('', '0'):
+    enable(os.environ.get('INSTRUMENT_OUTPUT'), os.environ.get('INSTRUMENT_PROFILE'))
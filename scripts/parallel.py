@@ -0,0 +1,294 @@
+# -*- coding: utf-8 -*-
+"""Parallel Model Selection"""
+
+import functools
+import itertools
+import multiprocessing
+import os
+import time
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import shared_memory
+from dataprocessing import build_X, build_k_indices
+from classifiers import LeastSquaresL2
+
+
+# environment variables limiting the number of threads of the BLAS libraries
+BLAS_THREADS_VARIABLES = [
+    "OMP_NUM_THREADS",
+    "OPENBLAS_NUM_THREADS",
+    "MKL_NUM_THREADS",
+    "VECLIB_MAXIMUM_THREADS",
+    "NUMEXPR_NUM_THREADS",
+]
+
+def blas_threads():
+    """Number of threads of the BLAS library of this process (from the BLAS thread variables, else all cores)"""
+    values = [ int(os.environ[var]) for var in BLAS_THREADS_VARIABLES[:-1] if os.environ.get(var, '').isdigit() ]
+    return max(1, min(values)) if values else os.cpu_count()
+
+
+# arrays shared with the worker processes, set by _init_worker
+_shared = {}
+
+
+def share_arrays(arrays):
+    """
+    Copies arrays into shared memory blocks.
+
+    :param arrays: dictionary of arrays
+    :return: shared memory blocks, descriptors (name, shape, dtype) to attach the arrays
+    """
+
+    blocks, descriptors = [], {}
+    for key, array in arrays.items():
+        array = np.ascontiguousarray(array)
+        block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+
+        blocks.append(block)
+        descriptors[key] = (block.name, array.shape, array.dtype.str)
+
+    return blocks, descriptors
+
+
+def attach_arrays(descriptors):
+    """
+    Attaches read-only views of arrays shared with share_arrays.
+
+    :param descriptors: descriptors returned by share_arrays
+    :return: shared memory blocks, dictionary of arrays
+    """
+
+    blocks, arrays = [], {}
+    for key, (name, shape, dtype) in descriptors.items():
+        block = shared_memory.SharedMemory(name=name)
+        array = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+        array.flags.writeable = False
+
+        blocks.append(block)
+        arrays[key] = array
+
+    return blocks, arrays
+
+
+def process_pool(n_jobs, blas_threads, initializer, initargs):
+    """
+    Creates a pool of freshly spawned processes.
+
+    The processes are spawned (not forked) with the BLAS thread variables set,
+    so that numpy is imported in the workers with blas_threads threads each
+    and the pool does not oversubscribe the cores.
+
+    :param n_jobs: number of processes
+    :param blas_threads: number of BLAS threads per process
+    :param initializer: function called at the start of every process
+    :param initargs: arguments of the initializer
+    :return: pool
+    """
+
+    saved = { var: os.environ.get(var) for var in BLAS_THREADS_VARIABLES }
+    try:
+        for var in BLAS_THREADS_VARIABLES:
+            os.environ[var] = str(blas_threads)
+
+        # multiprocessing.Pool starts all its processes in the constructor
+        return multiprocessing.get_context("spawn").Pool(n_jobs, initializer, initargs)
+    finally:
+        for var, value in saved.items():
+            if value is None:
+                del os.environ[var]
+            else:
+                os.environ[var] = value
+
+
+def _init_worker(descriptors):
+    """Attaches the shared arrays in a worker process"""
+    _shared['blocks'], _shared['arrays'] = attach_arrays(descriptors)
+
+
+def _cross_validate_task(task):
+    """Accuracies of one fold of one split for a whole lambda path"""
+    seed, split, fold, d_int, d_sq, lambdas = task
+    arrays = _shared['arrays']
+
+    # seed depends only on the task, not on the worker running it
+    np.random.seed(seed)
+
+    x, y, k_indices = arrays[f"X_{split}"], arrays[f"y_{split}"], arrays[f"k_indices_{split}"]
+
+    # training examples are all the examples outside of the fold
+    train = np.ones(x.shape[0], dtype=bool)
+    train[k_indices[fold]] = False
+
+    classifier = LeastSquaresL2(0, expand=functools.partial(build_X, d_int=d_int, d_sq=d_sq))
+    classifier.fit_path(y[train], x[train], lambdas)
+    y_pred = classifier.predict_path(x[k_indices[fold]])
+
+    return np.mean(y_pred == y[k_indices[fold]], axis=1)
+
+
+def grid_search_kfold(X_split, y_split, d_ints, d_sqs, lambdas, k_fold, n_jobs=None,
+                      blas_threads=1, seed=1):
+    """
+    Parallel grid search of LeastSquaresL2 with build_X expansion.
+
+    Every (split, fold, d_int, d_sq) combination is a task evaluating the whole
+    lambda path (see LeastSquaresL2.fit_path). Tasks are run by a pool of
+    processes reading the standardized splits from shared memory. The
+    accuracy of the splits is averaged per fold, then weighted by the size
+    of the splits (as in project1.ipynb). The accuracies are those of
+    cross_validate_kfold with a separate LeastSquaresL2 per lambda (see
+    benchmark_grid_search in benchmarks.py).
+
+    The results are grids indexed by (d_int, d_sq, lambda), e.g. for a given
+    d_sq index j:
+    surface3d_model(D_INT[:, j, :], np.log10(LAMBDA[:, j, :]), 100 * ACC[:, j, :], ytl)
+
+    :param X_split: standardized data of every split
+    :param y_split: labels of every split
+    :param d_ints: degrees of integer powers
+    :param d_sqs: degrees of half-powers
+    :param lambdas: regularization strengths
+    :param k_fold: number of folds
+    :param n_jobs: number of processes (None for all cores, 1 to run in this process)
+    :param blas_threads: number of BLAS threads per process
+    :param seed: seed of the folds and of the tasks
+    :return: D_INT, D_SQ, LAMBDA, ACC grids
+    """
+
+    if n_jobs is None:
+        n_jobs = os.cpu_count()
+
+    # the same folds as cross_validate_kfold
+    arrays = {}
+    for i, (X, y) in enumerate(zip(X_split, y_split)):
+        arrays[f"X_{i}"] = X
+        arrays[f"y_{i}"] = y
+        arrays[f"k_indices_{i}"] = build_k_indices(y, k_fold, seed)
+
+    combinations = list(itertools.product(range(len(X_split)), range(k_fold), d_ints, d_sqs))
+    task_seeds = np.random.SeedSequence(seed).generate_state(len(combinations))
+    tasks = [ (int(task_seed), split, fold, d_int, d_sq, lambdas)
+              for task_seed, (split, fold, d_int, d_sq) in zip(task_seeds, combinations) ]
+
+    if n_jobs == 1:
+        _shared['arrays'] = arrays
+        try:
+            results = [ _cross_validate_task(task) for task in tasks ]
+        finally:
+            _shared.clear()
+    else:
+        blocks, descriptors = share_arrays(arrays)
+        try:
+            with process_pool(n_jobs, blas_threads, _init_worker, (descriptors,)) as pool:
+                results = pool.map(_cross_validate_task, tasks)
+        finally:
+            for block in blocks:
+                block.close()
+                block.unlink()
+
+    # mean over folds, weighted mean over splits
+    accuracies = np.array(results).reshape(len(X_split), k_fold, len(d_ints), len(d_sqs), len(lambdas))
+    sizes = np.array([ len(y) for y in y_split ])
+    ACC = np.tensordot(sizes / np.sum(sizes), accuracies.mean(axis=1), axes=1)
+
+    D_INT, D_SQ, LAMBDA = np.meshgrid(d_ints, d_sqs, lambdas, indexing='ij')
+
+    return D_INT, D_SQ, LAMBDA, ACC
+
+
+def _timed(function, *args):
+    """Result, wall time and CPU time of the calling thread of a function call"""
+    start, start_cpu = time.perf_counter(), time.thread_time()
+    result = function(*args)
+    return result, time.perf_counter() - start, time.thread_time() - start_cpu
+
+
+def map_splits(function, *splits, n_jobs=None):
+    """
+    Applies a function to every split in its own thread.
+
+    The splits are independent and numpy releases the GIL in the expansion
+    and matrix products, so threads run them concurrently without copying
+    the data. Threads (unlike processes) share the BLAS configuration of the
+    main process, so the results are exactly those of a serial loop.
+
+    Every thread calls BLAS with its full pool of threads, so by default the
+    number of threads is capped to the cores left by that pool: with the
+    default BLAS configuration (one thread per core) the splits run one after
+    the other and BLAS uses all the cores within each split, while with
+    OPENBLAS_NUM_THREADS=1 (or OMP_NUM_THREADS=1, ...) one split runs per core.
+
+    :param function: function applied to the elements of every split
+    :param splits: lists with one element per split (e.g. models, X_split, y_split)
+    :param n_jobs: number of threads (None for os.cpu_count() // blas_threads(), 1 to run in this thread)
+    :return: results, wall times, CPU times (one per split)
+    """
+
+    tasks = list(zip(*splits))
+    if n_jobs is None:
+        n_jobs = max(1, os.cpu_count() // blas_threads())
+
+    if n_jobs == 1 or len(tasks) <= 1:
+        timed = [ _timed(function, *task) for task in tasks ]
+    else:
+        with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+            timed = list(executor.map(lambda task: _timed(function, *task), tasks))
+
+    results, wall_times, cpu_times = zip(*timed) if timed else ((), (), ())
+
+    return list(results), list(wall_times), list(cpu_times)
+
+
+def fit_splits(models, X_split, y_split, n_jobs=None):
+    """
+    Fits one classifier per split concurrently (see map_splits).
+
+    :param models: classifiers, one per split
+    :param X_split: data of every split
+    :param y_split: labels of every split
+    :param n_jobs: number of threads (None for the cores left by the BLAS threads)
+    :return: wall times, CPU times
+    """
+
+    _, wall_times, cpu_times = map_splits(lambda model, X, y: model.fit(y, X), models, X_split, y_split,
+                                          n_jobs=n_jobs)
+
+    return wall_times, cpu_times
+
+
+def predict_splits(models, X_split, split_indices, n, n_jobs=None):
+    """
+    Predicts every split with its classifier concurrently (see map_splits).
+
+    :param models: classifiers, one per split
+    :param X_split: data of every split
+    :param split_indices: rows of every split in the full data
+    :param n: number of rows of the full data
+    :param n_jobs: number of threads (None for the cores left by the BLAS threads)
+    :return: predictions of the full data (1 for the rows of no split), wall times, CPU times
+    """
+
+    predictions, wall_times, cpu_times = map_splits(lambda model, X: model.predict(X), models, X_split,
+                                                    n_jobs=n_jobs)
+
+    y_pred = np.ones(n)
+    for indices, y_pred_split in zip(split_indices, predictions):
+        y_pred[indices] = y_pred_split
+
+    return y_pred, wall_times, cpu_times
+
+
+def print_split_times(name, X_split, wall_times, cpu_times):
+    """
+    Prints the time spent on every split.
+
+    :param name: name of the stage
+    :param X_split: data of every split
+    :param wall_times: wall times of every split
+    :param cpu_times: CPU times of every split
+    """
+
+    for i, (X, wall_time, cpu_time) in enumerate(zip(X_split, wall_times, cpu_times)):
+        print(f"{name} split {i}: {X.shape[0]} rows, {wall_time:.2f}s wall, {cpu_time:.2f}s CPU")
@@ -1,23 +1,46 @@
 # -*- coding: utf-8 -*-
 """some helper functions for project 1."""
-import csv
+import gzip
+import itertools
+import json
+import os
 import numpy as np
+from instrumentation import instrumented
 
 
-def load_csv_data(data_path, sub_sample=False):
-    """Loads data and returns y (class labels), tX (features) and ids (event ids)"""
-    y = np.genfromtxt(data_path, delimiter=",", skip_header=1, dtype=str, usecols=1)
-    x = np.genfromtxt(data_path, delimiter=",", skip_header=1)
-    ids = x[:, 0].astype(np.int)
-    input_data = x[:, 2:]
+@instrumented
+def load_csv_data(data_path, sub_sample=False, dtype=np.float64, chunk_size=50000,
+                  cache=True, rebuild_cache=False):
+    """
+    Loads data and returns y (class labels), tX (features) and ids (event ids)
+
+    The file is read in a single pass, chunk_size rows at a time, straight into
+    preallocated arrays (grown if the size estimate was too small).
+
+    The parsed arrays are cached as .npy files next to the csv file and opened as
+    copy-on-write memory maps on the next calls: the arrays are writable like
+    parsed ones, pages are shared with the page cache until they are written
+    and writes never reach the cache files. The cache is rebuilt whenever the
+    path, size or modification time of the csv file (or the dtype) changes.
+
+    :param data_path: path of the csv file
+    :param sub_sample: only keep every 50th example
+    :param dtype: float type of the labels and features (e.g. np.float32)
+    :param chunk_size: number of rows parsed at once
+    :param cache: read and write the binary cache
+    :param rebuild_cache: parse the csv file again and overwrite the cache
+    :return: yb, input_data, ids, features
+    """
+    data = None
+    if cache and not rebuild_cache:
+        data = _read_cache(data_path, dtype)
 
-    # fetch features as strings to manipulate them afterwards
-    features = np.genfromtxt(data_path, delimiter=",", dtype=str, max_rows=1)
-    features = features[2:]
+    if data is None:
+        data = _parse_csv_data(data_path, dtype, chunk_size)
+        if cache:
+            _write_cache(data_path, dtype, data)
 
-    # convert class labels from strings to binary (-1,1)
-    yb = np.ones(len(y))
-    yb[np.where(y == 'b')] = -1
+    yb, input_data, ids, features = data
 
     # sub-sample
     if sub_sample:
@@ -25,7 +48,264 @@ def load_csv_data(data_path, sub_sample=False):
         input_data = input_data[::50]
         ids = ids[::50]
 
-    return yb, input_data, ids, list(features)
+    return yb, input_data, ids, features
+
+
+def iter_csv_data(data_path, chunk_size=50000, dtype=np.float64):
+    """
+    Reads the csv file chunk by chunk, memory is bounded by chunk_size rows
+
+    :param data_path: path of the csv file
+    :param chunk_size: number of rows per chunk
+    :param dtype: float type of the labels and features
+    :return: generator of (yb, input_data, ids, features) chunks
+    """
+    with open(data_path, 'r') as f:
+        # fetch features as strings to manipulate them afterwards
+        features = f.readline().strip().split(",")[2:]
+
+        for lines in _iter_line_chunks(f, chunk_size):
+            ids, yb, input_data = _parse_lines(lines, dtype)
+            yield yb, input_data, ids, features
+
+
+def iter_data_chunks(data_path, chunk_size=50000, dtype=np.float64, cache=True):
+    """
+    Reads the data chunk by chunk from the binary cache, memory is bounded by chunk_size rows
+
+    Like iter_csv_data, but the chunks are slices of the memory-mapped cache of
+    load_csv_data, which is built chunk by chunk if it is missing or stale. Passes
+    over the data after the first one therefore cost no parsing. Falls back to
+    iter_csv_data if the cache is disabled or cannot be written.
+
+    :param data_path: path of the csv file
+    :param chunk_size: number of rows per chunk
+    :param dtype: float type of the labels and features
+    :param cache: read and write the binary cache
+    :return: generator of (yb, input_data, ids, features) chunks
+    """
+    data = None
+    if cache:
+        data = _read_cache(data_path, dtype) or _build_cache(data_path, dtype, chunk_size)
+
+    if data is None:
+        yield from iter_csv_data(data_path, chunk_size, dtype)
+        return
+
+    yb, input_data, ids, features = data
+    for start in range(0, len(yb), chunk_size):
+        rows = slice(start, start + chunk_size)
+        yield yb[rows], input_data[rows], ids[rows], features
+
+
+def _count_rows(data_path):
+    """Number of lines after the header of a csv file (upper bound of its number of rows)"""
+    n, last = 0, b'\n'
+    with open(data_path, 'rb') as f:
+        f.readline()
+        for block in iter(lambda: f.read(1 << 24), b''):
+            n += block.count(b'\n')
+            last = block[-1:]
+
+    # last line without end of line
+    return n + (last != b'\n')
+
+
+def _build_cache(data_path, dtype, chunk_size):
+    """
+    Parses the csv file chunk by chunk straight into the cache files
+
+    Memory is bounded by chunk_size rows. Returns the cached arrays as memory
+    maps (see _read_cache), or None if the cache cannot be written.
+    """
+    directory = _cache_dir(data_path, dtype)
+    capacity = _count_rows(data_path)
+    try:
+        os.makedirs(directory, exist_ok=True)
+
+        arrays, n, features = None, 0, None
+        for yb, input_data, ids, features in iter_csv_data(data_path, chunk_size, dtype):
+            if arrays is None:
+                shapes = [ (capacity,), (capacity, input_data.shape[1]), (capacity,) ]
+                dtypes = [ dtype, dtype, int ]
+                arrays = [ np.lib.format.open_memmap(os.path.join(directory, name + '.npy.tmp'), mode='w+',
+                                                     dtype=array_dtype, shape=shape)
+                           for name, shape, array_dtype in zip(CACHE_ARRAYS, shapes, dtypes) ]
+
+            m = len(yb)
+            for array, chunk in zip(arrays, (yb, input_data, ids)):
+                array[n:n + m] = chunk
+            n += m
+
+        empty = arrays is None
+        for array in arrays or []:
+            array.flush()
+        del arrays
+
+        tmp_paths = [ os.path.join(directory, name + '.npy.tmp') for name in CACHE_ARRAYS ]
+        if empty or n != capacity:
+            # empty or irregular (e.g. blank lines) files are parsed in memory
+            for tmp_path in tmp_paths:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+            _write_cache(data_path, dtype, _parse_csv_data(data_path, dtype, chunk_size))
+            return _read_cache(data_path, dtype)
+
+        for name, tmp_path in zip(CACHE_ARRAYS, tmp_paths):
+            os.replace(tmp_path, os.path.join(directory, name + '.npy'))
+
+        # meta.json is written last so that an interrupted build is never read
+        tmp_path = os.path.join(directory, 'meta.json.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump({'key': _cache_key(data_path, dtype), 'features': features}, f)
+        os.replace(tmp_path, os.path.join(directory, 'meta.json'))
+    except OSError:
+        return None
+
+    return _read_cache(data_path, dtype)
+
+
+def _parse_csv_data(data_path, dtype, chunk_size):
+    """Parses the csv file in a single pass, returns yb, input_data, ids, features"""
+    with open(data_path, 'r') as f:
+        # fetch features as strings to manipulate them afterwards
+        features = f.readline().strip().split(",")[2:]
+        d = len(features)
+
+        yb = ids = input_data = None
+        n = 0
+
+        for lines in _iter_line_chunks(f, chunk_size):
+            chunk_ids, chunk_yb, chunk_input_data = _parse_lines(lines, dtype)
+            m = len(chunk_ids)
+
+            if input_data is None:
+                # allocate once from the average line length of the first chunk
+                capacity = _estimate_rows(data_path, lines)
+                yb = np.empty(capacity, dtype=dtype)
+                ids = np.empty(capacity, dtype=int)
+                input_data = np.empty((capacity, d), dtype=dtype)
+            elif n + m > len(yb):
+                capacity = max(n + m, int(1.5 * len(yb)))
+                yb.resize(capacity, refcheck=False)
+                ids.resize(capacity, refcheck=False)
+                input_data.resize((capacity, d), refcheck=False)
+
+            ids[n:n + m] = chunk_ids
+            yb[n:n + m] = chunk_yb
+            input_data[n:n + m] = chunk_input_data
+            n += m
+
+    if input_data is None:
+        yb, ids, input_data = np.empty(0, dtype=dtype), np.empty(0, dtype=int), np.empty((0, d), dtype=dtype)
+    else:
+        # release the unused capacity
+        yb.resize(n, refcheck=False)
+        ids.resize(n, refcheck=False)
+        input_data.resize((n, d), refcheck=False)
+
+    return yb, input_data, ids, features
+
+
+def _parse_lines(lines, dtype):
+    """Parses csv lines into ids (int), labels and features (dtype)"""
+    # labels are converted from strings to binary (-1,1) while parsing
+    chunk = np.loadtxt(lines, delimiter=",", dtype=np.float64, ndmin=2, encoding="latin1",
+                       converters={1: _label_to_float})
+
+    # parsed in float64 so that ids above 2**24 survive float32 data (exact up to 2**53)
+    return chunk[:, 0].astype(int), chunk[:, 1].astype(dtype, copy=False), chunk[:, 2:].astype(dtype, copy=False)
+
+
+def _iter_line_chunks(f, chunk_size):
+    """Yields lists of at most chunk_size lines of an open file, without blank lines"""
+    while True:
+        lines = list(itertools.islice(f, chunk_size))
+        if not lines:
+            return
+
+        # blank lines (e.g. at the end of the file) are skipped, as np.loadtxt does
+        lines = [ line for line in lines if not line.isspace() ]
+        if lines:
+            yield lines
+
+
+def _estimate_rows(data_path, lines):
+    """Estimates the number of rows of a csv file from a sample of its lines"""
+    avg_line = sum(len(line) for line in lines) / len(lines)
+    return max(len(lines), int(1.02 * os.path.getsize(data_path) / avg_line))
+
+
+def _label_to_float(label):
+    """Converts a class label string to -1 (background 'b') or 1"""
+    return -1. if label.strip() == 'b' else 1.
+
+
+CACHE_ARRAYS = ['yb', 'input_data', 'ids']
+
+
+def _cache_dir(data_path, dtype):
+    """Directory of the binary cache of a csv file"""
+    data_path = os.path.abspath(data_path)
+    return os.path.join(os.path.dirname(data_path), '.cache',
+                        os.path.basename(data_path) + '.' + np.dtype(dtype).name)
+
+
+def _cache_key(data_path, dtype):
+    """Identifies the version of a csv file the cache was built from"""
+    stat = os.stat(data_path)
+    return {
+        'path': os.path.abspath(data_path),
+        'size': stat.st_size,
+        'mtime_ns': stat.st_mtime_ns,
+        'dtype': np.dtype(dtype).name,
+    }
+
+
+def _read_cache(data_path, dtype):
+    """
+    Opens the cached arrays as copy-on-write memory maps, returns None if the cache is missing or stale
+
+    The arrays are writable (like freshly parsed ones) and plain ndarray views,
+    so that the results of load_csv_data do not depend on whether the cache was hit.
+    """
+    directory = _cache_dir(data_path, dtype)
+    try:
+        with open(os.path.join(directory, 'meta.json')) as f:
+            meta = json.load(f)
+        if meta['key'] != _cache_key(data_path, dtype):
+            return None
+        yb, input_data, ids = [ np.load(os.path.join(directory, name + '.npy'), mmap_mode='c').view(np.ndarray)
+                                for name in CACHE_ARRAYS ]
+    except (OSError, ValueError, KeyError):
+        return None
+
+    return yb, input_data, ids, meta['features']
+
+
+def _write_cache(data_path, dtype, data):
+    """Writes the parsed arrays to the cache, silently gives up if it is not writable"""
+    directory = _cache_dir(data_path, dtype)
+    yb, input_data, ids, features = data
+    try:
+        os.makedirs(directory, exist_ok=True)
+
+        # files are replaced rather than overwritten so that memory maps opened
+        # by other processes keep pointing to valid (old) data, and meta.json
+        # is written last so that an interrupted write is never read
+        items = [ (name + '.npy', array) for name, array in zip(CACHE_ARRAYS, (yb, input_data, ids)) ]
+        items.append(('meta.json', {'key': _cache_key(data_path, dtype), 'features': features}))
+        for filename, item in items:
+            tmp_path = os.path.join(directory, filename + '.tmp')
+            if filename == 'meta.json':
+                with open(tmp_path, 'w') as f:
+                    json.dump(item, f)
+            else:
+                with open(tmp_path, 'wb') as f:
+                    np.save(f, item)
+            os.replace(tmp_path, os.path.join(directory, filename))
+    except OSError:
+        pass
 
 
 def predict_labels(weights, data):
@@ -37,16 +317,21 @@ def predict_labels(weights, data):
     return y_pred
 
 
-def create_csv_submission(ids, y_pred, name):
+@instrumented
+def create_csv_submission(ids, y_pred, name, append=False):
     """
     Creates an output file in csv format for submission to kaggle
     Arguments: ids (event ids associated with each prediction)
                y_pred (predicted class labels)
-               name (string name of .csv output file to be created)
-    """
-    with open(name, 'w') as csvfile:
-        fieldnames = ['Id', 'Prediction']
-        writer = csv.DictWriter(csvfile, delimiter=",", fieldnames=fieldnames)
-        writer.writeheader()
-        for r1, r2 in zip(ids, y_pred):
-            writer.writerow({'Id':int(r1),'Prediction':int(r2)})
+               name (string name of .csv output file to be created, gzipped if it ends with .gz)
+               append (append the rows to an existing file, without header)
+    """
+    # format all the rows with a single formatting operation
+    rows = np.column_stack((ids, y_pred)).astype(np.int64).ravel().tolist()
+    lines = ("%d,%d\r\n" * len(ids)) % tuple(rows)
+
+    opener = gzip.open if name.endswith('.gz') else open
+    with opener(name, 'ab' if append else 'wb') as csvfile:
+        if not append:
+            csvfile.write(b"Id,Prediction\r\n")
+        csvfile.write(lines.encode())
@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 """Run"""
 
+import argparse
+import sys
 import numpy as np
 import matplotlib.pyplot as plt
 from proj1_helpers import *
@@ -8,55 +10,123 @@ from implementations import *
 from dataprocessing import *
 from classifiers import *
 from solver import *
+from parallel import fit_splits, predict_splits, print_split_times
+from streaming import read_features, fit_out_of_core
+from score import score_models
+from instrumentation import stage
+import instrumentation
+
+
+parser = argparse.ArgumentParser(description="Trains the models and writes the test set predictions")
+parser.add_argument("--no-cache", dest="cache", action="store_false",
+                    help="parse the csv files without reading or writing the binary cache")
+parser.add_argument("--rebuild-cache", action="store_true",
+                    help="parse the csv files again and overwrite the binary cache")
+parser.add_argument("--block-size", type=int, default=None,
+                    help="expand and accumulate the normal equations this many rows at a time "
+                         "instead of building the full expanded matrices (the rounding changes the weights of the "
+                         "badly conditioned models: 91%% to 100%% of the predictions are the same, depending on "
+                         "the data and block size)")
+parser.add_argument("--float32", action="store_true",
+                    help="load, standardize and expand the data in single precision "
+                         "(half the memory, normal equations still accumulated in float64)")
+parser.add_argument("--n-jobs", type=int, default=None,
+                    help="number of jet splits trained and predicted concurrently, each using all the BLAS "
+                         "threads (default: the cores divided by the BLAS threads, i.e. one at a time unless "
+                         "e.g. OPENBLAS_NUM_THREADS=1 trades the BLAS threads for concurrent splits)")
+parser.add_argument("--out-of-core", action="store_true",
+                    help="never load the csv files in memory: fit the preprocessing and the models "
+                         "and predict chunk by chunk (memory independent of the number of rows)")
+parser.add_argument("--chunk-size", type=int, default=50000,
+                    help="number of rows read at once with --out-of-core")
+parser.add_argument("--model-dir", default=None,
+                    help="save the trained models and preprocessing to this directory (see load_models)")
+parser.add_argument("--instrument", action="store_true",
+                    help="print the wall time, CPU time, peak memory and array sizes of every stage "
+                         "(also enabled by the INSTRUMENT environment variable)")
+parser.add_argument("--instrument-output", default=None,
+                    help="save the report of --instrument as json to this file")
+parser.add_argument("--profile", default=None,
+                    help="profile the main thread with cProfile and dump the statistics to this file "
+                         "(with --n-jobs 1 to include the fits and predictions)")
+args = parser.parse_args()
+
+if args.instrument or args.instrument_output is not None or args.profile is not None:
+    instrumentation.enable(args.instrument_output, args.profile)
 
 
 """
-TRAIN DATA PULL
+MODEL VALUES
 """
 
-# fetch train data
 DATA_TRAIN_PATH = "../data/train.csv"
-y, tX, ids, features = load_csv_data(DATA_TRAIN_PATH, sub_sample=False)
-
-"""
-FEATURE ENGINEERING
-"""
-
-# split data
-indices_split, X_split, y_split = split_data(features, tX, y)
-
-# standardize data
-X_split_std, mean_split, std_split = [], [], []
-for X in X_split: 
-    # remove features with more than 20% of NaN and standardize
-    X_std, mean_std, std_std = standardize(remove_NaN_features(X, 0.2))
-    
-    X_split_std.append(X_std)
-    mean_split.append(mean_std)
-    std_split.append(std_std)
+DATA_TEST_PATH = "../data/test.csv"
+OUTPUT_PATH = "../results/predictions.csv"
 
 # model values
 best_lambda = 3.5938136638046255e-12
 best_deg_int = 10
 best_deg_sq = 5
 
-def model_split_data(X):
-    return build_X(X, best_deg_int, best_deg_sq)
+dtype = np.float32 if args.float32 else np.float64
+
+
+if args.out_of_core:
+    """
+    OUT-OF-CORE FIT AND PREDICT
+    """
 
-# build expanded data
-X_split_poly = [ model_split_data(X) for X in X_split_std ]
+    # preprocessing statistics and normal equations are accumulated chunk by chunk
+    pipeline = Pipeline(read_features(DATA_TRAIN_PATH), nan_threshold=0.2, d_int=best_deg_int,
+                        d_sq=best_deg_sq, dtype=np.float32 if args.float32 else None)
+    with stage("fit out-of-core"):
+        models = fit_out_of_core(DATA_TRAIN_PATH, pipeline,
+                                 lambda: LeastSquaresL2(best_lambda, expand=pipeline.expand, block_size=args.block_size),
+                                 args.chunk_size, dtype, args.cache)
+
+    if args.model_dir is not None:
+        save_models(args.model_dir, models, pipeline)
+
+    # stream the test data through the models
+    with stage("score out-of-core"):
+        score_models(models, pipeline, DATA_TEST_PATH, OUTPUT_PATH, args.chunk_size)
+    sys.exit()
+
+
+"""
+TRAIN DATA PULL
+"""
+
+# fetch train data
+with stage("load train data") as s:
+    y, tX, ids, features = load_csv_data(DATA_TRAIN_PATH, sub_sample=False, dtype=dtype,
+                                         cache=args.cache, rebuild_cache=args.rebuild_cache)
+    s.output(tX)
+
+"""
+FEATURE ENGINEERING
+"""
+
+# split data, remove features with more than 20% of NaN and standardize
+pipeline = Pipeline(features, nan_threshold=0.2, d_int=best_deg_int, d_sq=best_deg_sq,
+                    dtype=np.float32 if args.float32 else None)
+with stage("preprocess train data", tX) as s:
+    indices_split, X_split_std, y_split = pipeline.fit_transform(tX, y, expand=False)
+    s.output(X_split_std)
 
 
 """
 FIT AND PREDICT
 """
 
-# train actual models
-models = []
-for X_, y_ in zip(X_split_poly, y_split):
-    lse = LeastSquaresL2(best_lambda)
-    lse.fit(y_, X_)
-    models.append(lse)
+# train actual models concurrently (the data is expanded by the models, block by block if needed)
+models = [ LeastSquaresL2(best_lambda, expand=pipeline.expand, block_size=args.block_size) for _ in X_split_std ]
+with stage("fit", X_split_std):
+    fit_times = fit_splits(models, X_split_std, y_split, n_jobs=args.n_jobs)
+print_split_times("fit", X_split_std, *fit_times)
+
+if args.model_dir is not None:
+    save_models(args.model_dir, models, pipeline)
 
     
 """
@@ -64,32 +134,27 @@ TEST DATA PULL
 """
 
 # fetch test data
-DATA_TEST_PATH = "../data/test.csv"
-y_test, tX_test, ids_test, features_test = load_csv_data(DATA_TEST_PATH, sub_sample=False)
+with stage("load test data") as s:
+    y_test, tX_test, ids_test, features_test = load_csv_data(DATA_TEST_PATH, sub_sample=False, dtype=dtype,
+                                                             cache=args.cache, rebuild_cache=args.rebuild_cache)
+    s.output(tX_test)
 
-# split
-test_split_indices, X_test_split, _ = split_data(features_test, tX_test)
+# split and standardize with the training state
+with stage("preprocess test data", tX_test) as s:
+    test_split_indices, X_test_split_std, _ = pipeline.transform(tX_test, expand=False)
+    s.output(X_test_split_std)
 
-# standardize
-X_test_split_std = []
-for X, mean, std in zip(X_test_split, mean_split, std_split): 
-    # remove features with more than 20% of NaN and standardize
-    X_test_std, _, _ = standardize(remove_NaN_features(X, 0.2), mean, std)
-    
-    X_test_split_std.append(X_test_std)
-    
-# expand
-X_test_split_poly = [ model_split_data(X) for X in X_test_split_std ]
-
-# predictions using new model
-y_pred = np.ones(tX_test.shape[0])
-for model, X, indices in zip(models, X_test_split_poly, test_split_indices):
-    y_pred[indices] = model.predict(X)
+# predictions using new model, split by split concurrently
+with stage("predict", X_test_split_std) as s:
+    y_pred, *predict_times = predict_splits(models, X_test_split_std, test_split_indices, tX_test.shape[0],
+                                            n_jobs=args.n_jobs)
+    s.output(y_pred)
+print_split_times("predict", X_test_split_std, *predict_times)
 
 
 """
 OUTPUT PREDICTIONS
 """
 
-OUTPUT_PATH = "../results/predictions.csv"
-create_csv_submission(ids_test, y_pred, OUTPUT_PATH)
+with stage("write predictions", y_pred):
+    create_csv_submission(ids_test, y_pred, OUTPUT_PATH)
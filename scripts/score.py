@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+"""Batch scoring with saved models"""
+
+import argparse
+import sys
+import time
+import numpy as np
+from proj1_helpers import iter_csv_data, create_csv_submission
+from classifiers import load_models
+
+
+def predict_chunk(models, pipeline, X):
+    """
+    Predicts a chunk of raw data with the model of its split.
+
+    :param models: classifiers, one per split
+    :param pipeline: fitted dataprocessing.Pipeline
+    :param X: raw data
+    :return: predicted labels
+    """
+
+    split_indices, X_split, _ = pipeline.transform(X, expand=False)
+
+    y_pred = np.ones(X.shape[0])
+    for model, X_, indices in zip(models, X_split, split_indices):
+        if len(X_):
+            y_pred[indices] = model.predict(X_)
+
+    return y_pred
+
+
+def score(model_dir, input_path, output_path, chunk_size=50000, verbose=True):
+    """
+    Streams a csv file through saved models and writes the predictions chunk by chunk.
+
+    Memory is bounded by chunk_size rows whatever the size of the input.
+
+    :param model_dir: directory of models saved with save_models
+    :param input_path: csv file to score
+    :param output_path: csv file of the predictions (gzipped if it ends with .gz)
+    :param chunk_size: number of rows read, expanded and predicted at once
+    :param verbose: print progress and throughput
+    :return: number of rows scored
+    """
+
+    models, pipeline = load_models(model_dir)
+
+    return score_models(models, pipeline, input_path, output_path, chunk_size, verbose)
+
+
+def score_models(models, pipeline, input_path, output_path, chunk_size=50000, verbose=True):
+    """
+    Streams a csv file through trained models and writes the predictions chunk by chunk.
+
+    :param models: classifiers, one per split
+    :param pipeline: fitted dataprocessing.Pipeline
+    :param input_path: csv file to score
+    :param output_path: csv file of the predictions (gzipped if it ends with .gz)
+    :param chunk_size: number of rows read, expanded and predicted at once
+    :param verbose: print progress and throughput
+    :return: number of rows scored
+    """
+
+    start = time.perf_counter()
+
+    n = 0
+    for _, X, ids, _ in iter_csv_data(input_path, chunk_size):
+        y_pred = predict_chunk(models, pipeline, X)
+        create_csv_submission(ids, y_pred, output_path, append=n > 0)
+
+        n += len(ids)
+        if verbose:
+            elapsed = time.perf_counter() - start
+            print(f"{n} rows - {n / elapsed:.0f} rows/s", file=sys.stderr)
+
+    if n == 0:
+        # header only
+        create_csv_submission(np.empty(0), np.empty(0), output_path)
+
+    if verbose:
+        elapsed = time.perf_counter() - start
+        print(f"Scored {n} rows in {elapsed:.2f}s ({n / elapsed:.0f} rows/s)", file=sys.stderr)
+
+    return n
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Predicts a csv file with models saved by run.py --model-dir")
+    parser.add_argument("--models", required=True, help="directory of the saved models")
+    parser.add_argument("--input", default="../data/test.csv", help="csv file to score")
+    parser.add_argument("--output", default="../results/predictions.csv", help="csv file of the predictions")
+    parser.add_argument("--chunk-size", type=int, default=50000, help="number of rows scored at once")
+    parser.add_argument("--quiet", action="store_true", help="do not print progress")
+    args = parser.parse_args()
+
+    score(args.models, args.input, args.output, args.chunk_size, verbose=not args.quiet)
@@ -1,9 +1,18 @@
 # -*- coding: utf-8 -*-
 """Solver"""
 
+import math
+import time
 import numpy as np
+from instrumentation import instrumented
 
 
+# number of rows of single precision data converted to double precision at once
+# by normal_equations and block_matmul
+GRAM_BLOCK_SIZE = 10000
+
+
+@instrumented
 def gradient_descent(function_object, w, max_evaluations, *args, verbose=False):
     """
     Find minimum
@@ -88,6 +97,7 @@ def gradient_descent(function_object, w, max_evaluations, *args, verbose=False):
 
     return w, f
 
+@instrumented
 def gradient_descent_L1(function_object, w, L1_lambda, max_evaluations, *args, verbose=False):
     """
     Find minimum L1
@@ -173,3 +183,624 @@ def gradient_descent_L1(function_object, w, L1_lambda, max_evaluations, *args, v
     return w, f
 
 
+@instrumented
+def lasso_coordinate_descent(Q, c, L1_lambda, w=None, max_evaluations=100, lambda_prev=None,
+                             tol=1e-4, verbose=False):
+    """
+    Find minimum L1
+
+    Minimizes 1/2 w.T Q w - c.T w + L1_lambda * |w|_1 (least squares with
+    Q = X.T @ X / n and c = X.T @ y / n) by cyclic coordinate descent with
+    covariance updates: the residual correlations r = c - Q w are kept up
+    to date, so that changing one weight costs O(d) and zero weights cost
+    nothing.
+
+    Only the features passing the sequential strong rule
+    |r_j| >= 2 * L1_lambda - lambda_prev (w being the solution at lambda_prev)
+    are visited, sweeping the nonzero weights until convergence between two
+    sweeps of that set. The discarded features violating the optimality
+    conditions |r_j| <= L1_lambda are added back until there are none.
+
+    :param Q: Gram matrix divided by the number of examples
+    :param c: moment vector divided by the number of examples
+    :param L1_lambda: lambda
+    :param w: initial weight (warm start, zeros if None)
+    :param max_evaluations: maximum number of sweeps
+    :param lambda_prev: lambda at which w is a solution (largest useful lambda if None)
+    :param tol: tolerance on the largest change of a weight relative to the largest weight
+                (both scaled by sqrt(Q_jj), i.e. measured on the predictions)
+    :param verbose: print output
+    :return: weight, loss (without the constant y.T @ y / 2n)
+    """
+    d = len(c)
+    w = np.zeros(d) if w is None else np.array(w, dtype=np.float64)
+    r = c - Q @ w
+    diag = np.diag(Q)
+    scale = np.sqrt(np.maximum(diag, 0.))
+
+    # above the largest useful lambda, max |c_j|, all weights are zero
+    if lambda_prev is None:
+        lambda_prev = max(np.max(np.abs(c)), L1_lambda)
+
+    # constant (e.g. all zero) features keep a zero weight
+    usable = diag > 0
+    strong = usable & ((np.abs(r) >= 2 * L1_lambda - lambda_prev) | (w != 0))
+
+    sweeps = 0
+    while True:
+        while sweeps < max_evaluations:
+            # sweep the strong set, then the active set until convergence
+            change = _coordinate_sweep(Q, diag, r, w, np.flatnonzero(strong), L1_lambda)
+            sweeps += 1
+            if change <= tol * np.max(np.abs(w) * scale, initial=0.):
+                break
+
+            while sweeps < max_evaluations:
+                change = _coordinate_sweep(Q, diag, r, w, np.flatnonzero(strong & (w != 0)), L1_lambda)
+                sweeps += 1
+                if change <= tol * np.max(np.abs(w) * scale, initial=0.):
+                    break
+
+        # optimality conditions of the discarded features
+        violations = usable & ~strong & (np.abs(r) > L1_lambda)
+
+        if verbose > 0:
+            print("%d - active: %d - strong: %d - violations: %d"
+                  % (sweeps, np.count_nonzero(w), np.count_nonzero(strong), np.count_nonzero(violations)))
+
+        if not violations.any() or sweeps >= max_evaluations:
+            break
+
+        strong |= violations
+
+    if verbose and sweeps >= max_evaluations:
+        print("Reached maximum number of sweeps %d" % max_evaluations)
+
+    # 1/2 w.T Q w - c.T w = -1/2 (c + r).T w
+    f = -0.5 * (c + r).dot(w) + L1_lambda * np.sum(np.abs(w))
+
+    return w, f
+
+
+def _coordinate_sweep(Q, diag, r, w, indices, L1_lambda):
+    """One pass of coordinate descent updating w and r in place, returns the largest scaled change"""
+    change = 0.
+    for j in indices:
+        w_j, q_jj = w[j], diag[j]
+        z = r[j] + q_jj * w_j
+
+        # soft thresholding
+        if z > L1_lambda:
+            w_new = (z - L1_lambda) / q_jj
+        elif z < -L1_lambda:
+            w_new = (z + L1_lambda) / q_jj
+        else:
+            w_new = 0.
+
+        if w_new != w_j:
+            r -= (w_new - w_j) * Q[j]
+            w[j] = w_new
+            change = max(change, abs(w_new - w_j) * math.sqrt(q_jj))
+
+    return change
+
+
+@instrumented
+def lasso_path(G, b, n, lambdas, max_evaluations=100, tol=1e-4, verbose=False):
+    """
+    Lasso regularization path
+
+    Solves the L1-regularized least squares problem for every lambda with
+    lasso_coordinate_descent, from the largest lambda to the smallest, each
+    solution being the warm start (and the strong rule reference) of the next.
+
+    :param G: Gram matrix X.T @ X
+    :param b: moment vector X.T @ y
+    :param n: number of examples
+    :param lambdas: regularization strengths
+    :param max_evaluations: maximum number of sweeps per lambda
+    :param tol: tolerance of lasso_coordinate_descent
+    :param verbose: print output
+    :return: weights, one row per lambda (in the order of lambdas)
+    """
+    Q, c = G / n, b / n
+
+    W = np.empty((len(lambdas), len(b)))
+    w, lambda_prev = None, None
+    for i in np.argsort(lambdas)[::-1]:
+        w, _ = lasso_coordinate_descent(Q, c, lambdas[i], w, max_evaluations, lambda_prev, tol, verbose)
+        W[i] = w
+        lambda_prev = lambdas[i]
+
+    return W
+
+
+@instrumented
+def lbfgs(function_object, w, max_evaluations, *args, history=10, verbose=False):
+    """
+    Find minimum
+
+    Uses limited-memory BFGS with a strong Wolfe line search to optimize
+    function object. The inverse Hessian is approximated from the last
+    history steps and gradient differences (two-loop recursion).
+
+    :param function_object: loss function that returns loss and gradient
+    :param w: weight
+    :param max_evaluations: maximum number of evaluations
+    :param args: additional arguments (y, X)
+    :param history: number of stored steps
+    :param verbose: print output
+    :return: weight, loss
+    """
+    # set an optimality stopping criterion
+    optTol = 1e-2
+
+    # evaluate the initial function value and gradient
+    f, g = function_object(w, *args)
+    evals = 1
+
+    S, Y = [], []
+
+    while np.linalg.norm(g, float('inf')) >= optTol and evals < max_evaluations:
+        # quasi-Newton direction
+        d = -_lbfgs_direction(g, S, Y)
+        gtd = g.dot(d)
+
+        if not gtd < 0:
+            # not a descent direction, restart from the gradient
+            if verbose: print("Not a descent direction, resetting the history")
+            S, Y = [], []
+            d = -g
+            gtd = g.dot(d)
+
+        # first step is scaled by the gradient, the next ones are well scaled by the history
+        gamma = 1. if S else min(1., 1. / np.sum(np.abs(g)))
+
+        gamma, f_new, g_new, w_evals = wolfe_line_search(function_object, w, f, g, d, gamma,
+                                                         max_evaluations - evals, *args)
+        evals += w_evals
+
+        if gamma == 0:
+            if verbose: print("Line search failed to decrease the loss function")
+            break
+
+        # update history
+        s = gamma * d
+        y = g_new - g
+        if y.dot(s) > 1e-10:
+            S.append(s)
+            Y.append(y)
+            if len(S) > history:
+                S.pop(0)
+                Y.pop(0)
+
+        # update weights / loss / gradient
+        w = w + s
+        f = f_new
+        g = g_new
+
+        # print progress
+        if verbose:
+            print("%d - loss: %.3f" % (evals, f))
+
+    if verbose:
+        if np.linalg.norm(g, float('inf')) < optTol:
+            print("Problem solved up to optimality tolerance %.3f" % optTol)
+        elif evals >= max_evaluations:
+            print("Reached maximum number of function evaluations %d" % max_evaluations)
+
+    return w, f
+
+
+def _lbfgs_direction(g, S, Y):
+    """Approximate inverse Hessian times g (L-BFGS two-loop recursion)"""
+    q = g.copy()
+    alphas = []
+
+    for s, y in zip(reversed(S), reversed(Y)):
+        alpha = s.dot(q) / y.dot(s)
+        q -= alpha * y
+        alphas.append(alpha)
+
+    # initial inverse Hessian scaling
+    if S:
+        q *= S[-1].dot(Y[-1]) / Y[-1].dot(Y[-1])
+
+    for s, y, alpha in zip(S, Y, reversed(alphas)):
+        beta = y.dot(q) / y.dot(s)
+        q += (alpha - beta) * s
+
+    return q
+
+
+def wolfe_line_search(function_object, w, f, g, d, gamma, max_evaluations, *args, c1=1e-4, c2=0.9):
+    """
+    Strong Wolfe line search
+
+    Finds a step size gamma along d satisfying the sufficient decrease
+    f(w + gamma d) <= f + c1 gamma g.d and the curvature condition
+    |g(w + gamma d).d| <= c2 |g.d|, by extrapolation then zoom with cubic
+    interpolation (Nocedal & Wright, algorithms 3.5 and 3.6).
+
+    :param function_object: loss function that returns loss and gradient
+    :param w: weight
+    :param f: loss at w
+    :param g: gradient at w
+    :param d: descent direction
+    :param gamma: initial step size
+    :param max_evaluations: maximum number of evaluations
+    :param args: additional arguments (y, X)
+    :param c1: sufficient decrease parameter
+    :param c2: curvature parameter
+    :return: step size (0 if no decrease was found), loss, gradient, number of evaluations
+    """
+    gtd = g.dot(d)
+
+    # previous step of the extrapolation
+    prev = (0., f, g, gtd)
+    evals = 0
+
+    while evals < max(max_evaluations, 1):
+        f_new, g_new = function_object(w + gamma * d, *args)
+        evals += 1
+        gtd_new = g_new.dot(d)
+        new = (gamma, f_new, g_new, gtd_new)
+
+        if not np.isfinite(f_new) or f_new > f + c1 * gamma * gtd or (evals > 1 and f_new >= prev[1]):
+            return _zoom(function_object, w, f, gtd, d, prev, new, max_evaluations - evals, evals, args, c1, c2)
+
+        if abs(gtd_new) <= -c2 * gtd:
+            return gamma, f_new, g_new, evals
+
+        if gtd_new >= 0:
+            return _zoom(function_object, w, f, gtd, d, new, prev, max_evaluations - evals, evals, args, c1, c2)
+
+        # extrapolate
+        prev = new
+        gamma *= 2.
+
+    # out of evaluations, return the last step satisfying the sufficient decrease
+    gamma, f_new, g_new, _ = prev
+    return gamma, f_new, g_new, evals
+
+
+def _zoom(function_object, w, f, gtd, d, lo, hi, max_evaluations, evals, args, c1, c2):
+    """Zoom phase of wolfe_line_search, lo satisfies the sufficient decrease"""
+    for _ in range(max(max_evaluations, 0)):
+        gamma = _cubic_interpolation(lo, hi)
+
+        f_new, g_new = function_object(w + gamma * d, *args)
+        evals += 1
+        gtd_new = g_new.dot(d)
+
+        if not np.isfinite(f_new) or f_new > f + c1 * gamma * gtd or f_new >= lo[1]:
+            hi = (gamma, f_new, g_new, gtd_new)
+        else:
+            if abs(gtd_new) <= -c2 * gtd:
+                return gamma, f_new, g_new, evals
+
+            if gtd_new * (hi[0] - lo[0]) >= 0:
+                hi = lo
+            lo = (gamma, f_new, g_new, gtd_new)
+
+    # out of evaluations, return the best step found
+    gamma, f_new, g_new, _ = lo
+    return gamma, f_new, g_new, evals
+
+
+def _cubic_interpolation(a, b):
+    """Minimizer of the cubic interpolating two (step, loss, gradient, slope) points, safeguarded"""
+    (t_a, f_a, _, d_a), (t_b, f_b, _, d_b) = a, b
+    low, high = min(t_a, t_b), max(t_a, t_b)
+
+    with np.errstate(all='ignore'):
+        d1 = d_a + d_b - 3 * (f_a - f_b) / (t_a - t_b)
+        d2 = np.sign(t_b - t_a) * np.sqrt(d1 ** 2 - d_a * d_b)
+        t = t_b - (t_b - t_a) * (d_b + d2 - d1) / (d_b - d_a + 2 * d2)
+
+    # fall back to bisection if the cubic is degenerate or its minimizer too close to the bounds
+    if not np.isfinite(t) or t < low + 0.1 * (high - low) or t > high - 0.1 * (high - low):
+        t = (low + high) / 2.
+
+    return t
+
+
+@instrumented
+def newton(function_object, w, max_evaluations, *args, hessian=None, verbose=False, history=False):
+    """
+    Find minimum
+
+    Uses Newton's method (IRLS for logistic regression) to optimize function
+    object. The Newton system is solved by Cholesky factorization; if the
+    Hessian is not positive definite or ill-conditioned, it is damped
+    (H + mu I, with mu increased tenfold until it is well conditioned). The step
+    is then backtracked until the loss decreases enough.
+
+    :param function_object: loss function that returns loss and gradient
+    :param w: weight
+    :param max_evaluations: maximum number of evaluations
+    :param args: additional arguments (y, X)
+    :param hessian: function returning the Hessian matrix at w (with the same arguments)
+    :param verbose: print output
+    :param history: also return the history of the loss, number of evaluations and time per iteration
+    :return: weight, loss (, history)
+    """
+    # set an optimality stopping criterion
+    optTol = 1e-2
+
+    # linesearch param
+    linesearch_beta = 1e-4
+
+    # largest condition number accepted without damping
+    max_condition = 1e12
+
+    start = time.perf_counter()
+    trace = {'loss': [], 'evaluations': [], 'time': []}
+
+    # evaluate the initial function value and gradient
+    f, g = function_object(w, *args)
+    evals = 1
+    iterations = 0
+
+    while np.linalg.norm(g, float('inf')) >= optTol and evals < max_evaluations:
+        H = hessian(w, *args)
+        d = -_damped_cholesky_solve(H, g, max_condition, verbose)
+        gd = g.dot(d)
+
+        # backtracking from the full Newton step
+        gamma = 1.
+        while True:
+            w_new = w + gamma * d
+            f_new, g_new = function_object(w_new, *args)
+            evals += 1
+
+            if f_new <= f + linesearch_beta * gamma * gd or evals >= max_evaluations:
+                break
+
+            if verbose:
+                print("f_new: %.3f - f: %.3f - Backtracking..." % (f_new, f))
+            gamma /= 2.
+
+        if not f_new <= f:
+            # no decrease found within the evaluations
+            break
+
+        # update weights / loss / gradient
+        w = w_new
+        f = f_new
+        g = g_new
+        iterations += 1
+
+        if history:
+            trace['loss'].append(f)
+            trace['evaluations'].append(evals)
+            trace['time'].append(time.perf_counter() - start)
+
+        # print progress
+        if verbose:
+            print("%d - loss: %.3f" % (iterations, f))
+
+    if verbose:
+        print("Newton: %d iterations, %d evaluations, %.2fs - optimality %.3e"
+              % (iterations, evals, time.perf_counter() - start, np.linalg.norm(g, float('inf'))))
+
+    if history:
+        return w, f, trace
+
+    return w, f
+
+
+def _damped_cholesky_solve(H, g, max_condition, verbose):
+    """Solves H x = g by Cholesky, damping H until it is positive definite and well conditioned"""
+    d = H.shape[0]
+    mu = 0.
+    scale = max(np.trace(H) / d, 1e-12)
+
+    while True:
+        try:
+            L = np.linalg.cholesky(H + mu * np.eye(d) if mu else H)
+            # condition number estimated from the diagonal of the Cholesky factor
+            diag = np.abs(np.diag(L))
+            if (np.max(diag) / np.min(diag)) ** 2 < max_condition:
+                return _cholesky_solve(L, g)
+        except np.linalg.LinAlgError:
+            pass
+
+        mu = 1e-8 * scale if not mu else 10 * mu
+        if verbose:
+            print("Ill-conditioned Hessian, damping with mu=%.3e" % mu)
+
+
+def _cholesky_solve(L, g, block_size=64):
+    """
+    Solves L L.T x = g by forward and back substitution
+
+    The substitutions run by blocks of rows, so that the Python loop has
+    len(g) / block_size iterations: the solved part is eliminated with a
+    matrix product and only the small diagonal blocks are solved directly.
+    Costs O(d^2) instead of the O(d^3) of np.linalg.solve on the factors.
+
+    :param L: lower triangular Cholesky factor
+    :param g: right-hand side
+    :param block_size: number of rows solved at once
+    :return: solution x
+    """
+    d = len(g)
+
+    # forward substitution L z = g
+    z = np.empty(d)
+    for i in range(0, d, block_size):
+        j = min(i + block_size, d)
+        z[i:j] = np.linalg.solve(L[i:j, i:j], g[i:j] - L[i:j, :i] @ z[:i])
+
+    # back substitution L.T x = z
+    x = np.empty(d)
+    for j in range(d, 0, -block_size):
+        i = max(j - block_size, 0)
+        x[i:j] = np.linalg.solve(L[i:j, i:j].T, z[i:j] - L[j:, i:j].T @ x[j:])
+
+    return x
+
+
+@instrumented
+def weighted_gram(X, s, block_size=10000):
+    """
+    Weighted Gram matrix X.T @ diag(s) @ X
+
+    Accumulated block by block so that the weighted copy of X is never built in full.
+
+    :param X: data
+    :param s: weight of every example
+    :param block_size: number of rows per block
+    :return: weighted Gram matrix
+    """
+    H = np.zeros((X.shape[1], X.shape[1]))
+
+    for rows in row_blocks(X.shape[0], block_size):
+        X_block = X[rows].astype(np.float64, copy=False)
+        H += X_block.T @ (s[rows, None] * X_block)
+
+    return H
+
+
+def row_blocks(n, block_size=None):
+    """
+    Row slices of consecutive blocks
+
+    :param n: number of rows
+    :param block_size: number of rows per block (None for a single block)
+    :return: generator of slices
+    """
+    if block_size is None:
+        block_size = max(n, 1)
+
+    for start in range(0, n, block_size):
+        yield slice(start, min(start + block_size, n))
+
+
+def _block_size(X, block_size):
+    """Block size bounding the double precision copies of single precision data"""
+    if block_size is None and X.dtype != np.float64:
+        return GRAM_BLOCK_SIZE
+
+    return block_size
+
+
+@instrumented
+def block_matmul(X, W, expand=None, block_size=None):
+    """
+    Products X @ W of the expanded data
+
+    With a block size, the rows are expanded and multiplied block by block.
+    Single precision data is converted to float64 block by block (GRAM_BLOCK_SIZE
+    rows by default), so that the products are always computed in double precision.
+
+    :param X: data
+    :param W: weights (vector or matrix)
+    :param expand: function expanding a block of rows of X (e.g. build_X)
+    :param block_size: number of rows per block (None to use all rows at once)
+    :return: products, one row per row of X
+    """
+    block_size = _block_size(X, block_size)
+
+    if block_size is None:
+        return (X if expand is None else expand(X)) @ W
+
+    result = np.empty((X.shape[0],) + W.shape[1:])
+    for rows in row_blocks(X.shape[0], block_size):
+        X_block = X[rows] if expand is None else expand(X[rows])
+        result[rows] = X_block.astype(np.float64, copy=False) @ W
+
+    return result
+
+
+@instrumented
+def normal_equations(y, X, expand=None, block_size=None):
+    """
+    Normal equations
+
+    Computes the Gram matrix X.T @ X and the moment vector X.T @ y of the
+    expanded data. With a block size, the rows are expanded and accumulated
+    block by block so that the expanded matrix is never built in full and the
+    peak memory is O(d^2 + block_size * d) instead of O(n * d).
+
+    Single precision data (e.g. float32) is converted to float64 block by block
+    (GRAM_BLOCK_SIZE rows by default), so that G and b are always float64.
+
+    :param y: answers
+    :param X: data
+    :param expand: function expanding a block of rows of X (e.g. build_X)
+    :param block_size: number of rows per block (None to use all rows at once)
+    :return: Gram matrix, moment vector
+    """
+    n = X.shape[0]
+    G, b = None, None
+
+    block_size = _block_size(X, block_size)
+
+    for rows in row_blocks(n, block_size):
+        X_block = X[rows] if expand is None else expand(X[rows])
+
+        # the products are accumulated in double precision whatever the type of the data,
+        # the ridge solve being far more sensitive to rounding of G than of X
+        X_block = X_block.astype(np.float64, copy=False)
+
+        if G is None:
+            if block_size is None:
+                # single block, no accumulation needed
+                return X_block.T @ X_block, X_block.T @ y
+
+            d = X_block.shape[1]
+            G, b = np.zeros((d, d)), np.zeros(d)
+
+        G += X_block.T @ X_block
+        b += X_block.T @ y[rows]
+
+    return G, b
+
+
+@instrumented
+def ridge_path(G, b, n, lambdas):
+    """
+    Ridge regularization path
+
+    Solves (G + n * lambda * I) w = b for every lambda using a single
+    eigendecomposition G = V diag(s) V.T, so that each additional lambda only
+    costs a matrix-vector product.
+
+    The eigenvalues of a badly conditioned G (e.g. of the build_X(X, 10, 5)
+    expansion) are only known up to d * eps * max(s) and can come out negative,
+    so that s + n * lambda is dominated by rounding. The eigendecomposition is
+    therefore only used when n * lambda is well above that accuracy for every
+    lambda (bounded with the trace of G, before factorizing). Otherwise, as for
+    the lambdas of run.py, every lambda is solved directly with np.linalg.solve,
+    which gives the weights of LeastSquaresL2.fit: the path then only saves the
+    computation of the normal equations, one O(d^3) solve per lambda remains.
+
+    :param G: Gram matrix X.T @ X
+    :param b: moment vector X.T @ y
+    :param n: number of examples
+    :param lambdas: regularization strengths
+    :return: weights, one row per lambda
+    """
+    d = len(b)
+    W = np.empty((len(lambdas), d))
+
+    # bound of the accuracy of the eigenvalues (the trace of G bounds its largest eigenvalue)
+    tol = d * np.finfo(np.float64).eps * np.trace(G)
+
+    if len(lambdas) == 0 or n * np.min(lambdas) <= 2 * tol:
+        for i, lambda_ in enumerate(lambdas):
+            W[i] = np.linalg.solve(G + n * lambda_ * np.eye(d), b)
+        return W
+
+    s, V = np.linalg.eigh(G)
+    Vb = V.T @ b
+
+    for i, lambda_ in enumerate(lambdas):
+        if s[0] + n * lambda_ > tol:
+            W[i] = V @ (Vb / (s + n * lambda_))
+        else:
+            W[i] = np.linalg.solve(G + n * lambda_ * np.eye(d), b)
+
+    return W
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+"""Out-of-core Training"""
+
+import numpy as np
+from proj1_helpers import iter_data_chunks
+
+
+def read_features(data_path):
+    """
+    Reads the feature names of a csv file.
+
+    :param data_path: path of the csv file
+    :return: feature names
+    """
+
+    with open(data_path, 'r') as f:
+        return f.readline().strip().split(",")[2:]
+
+
+def split_chunks(data_path, pipeline, split, chunk_size=50000, dtype=np.float64, cache=True):
+    """
+    Chunks of one split of preprocessed training data.
+
+    Every call of the returned function starts a new pass over the file, reading
+    chunk_size rows at a time (see iter_data_chunks) and transforming them with
+    the fitted pipeline, so it can be given to the fit_chunks method of the classifiers.
+
+    :param data_path: path of the csv file
+    :param pipeline: fitted dataprocessing.Pipeline
+    :param split: index of the split
+    :param chunk_size: number of rows read at once
+    :param dtype: float type of the labels and features
+    :param cache: read and write the binary cache
+    :return: function returning a new iterator of (y, X) chunks of the split
+    """
+
+    def chunks():
+        for yb, X, _, _ in iter_data_chunks(data_path, chunk_size, dtype, cache):
+            _, X_split, y_split = pipeline.transform(X, yb, expand=False)
+            yield y_split[split], X_split[split]
+
+    return chunks
+
+
+def fit_out_of_core(data_path, pipeline, make_model, chunk_size=50000, dtype=np.float64, cache=True):
+    """
+    Trains one classifier per split on a file that does not need to fit in memory.
+
+    A first pass fits the pipeline (see Pipeline.fit_chunks), then every
+    classifier is trained from the chunks of its split (see the fit_chunks
+    methods: exact normal equations for least squares, one pass per evaluation
+    for logistic regression). Memory depends on chunk_size, not on the number of rows.
+
+    The pipeline state equals the in-memory one up to rounding. With the run.py
+    model the least squares weights do not (their normal equations have a
+    condition number around 1e31), but 99.6% or more of the predictions are the
+    same and the accuracy is unchanged (see benchmark_out_of_core in benchmarks.py).
+
+    :param data_path: path of the csv file
+    :param pipeline: dataprocessing.Pipeline, fitted by this function
+    :param make_model: function returning an untrained classifier, called once per split
+    :param chunk_size: number of rows read at once
+    :param dtype: float type of the labels and features
+    :param cache: read and write the binary cache
+    :return: trained classifiers, one per split
+    """
+
+    pipeline.fit_chunks(X for _, X, _, _ in iter_data_chunks(data_path, chunk_size, dtype, cache))
+
+    models = []
+    for split in range(len(pipeline.columns)):
+        model = make_model()
+        model.fit_chunks(split_chunks(data_path, pipeline, split, chunk_size, dtype, cache))
+        models.append(model)
+
+    return models